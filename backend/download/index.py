@@ -1,11 +1,71 @@
+import base64
+import gzip
 import json
+import mmap
 import os
 import re
-import psycopg2
+import time
+from collections import OrderedDict
 from datetime import datetime
 from urllib.parse import urlparse
 import requests
 
+import media_store
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Ответы меньше этого размера не сжимаются: заголовки и base64 съедят выигрыш
+MIN_COMPRESS_SIZE = 1024
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+# Порядок полей строки истории в компактном формате (?format=compact).
+# id и created_at передаются разностью с предыдущей строкой, file_path - null,
+# если совпадает с url: так сжатый ответ меньше полного формата
+COMPACT_HISTORY_COLUMNS = [
+    'id', 'url', 'type', 'title', 'file_path', 'size',
+    'thumbnail', 'cached', 'download_count', 'created_at'
+]
+COMPACT_DELTA_COLUMNS = ['id', 'created_at']
+
+# Прогресс загрузок: long-poll/SSE поверх таблицы download_jobs
+JOB_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]{8,64}$')
+JOB_FINAL_STATES = ('done', 'error')
+JOB_TTL_MINUTES = 60
+PROGRESS_WAIT_SECONDS = 20
+# Опрос БД с нарастающей паузой: около 12 запросов за long-poll вместо 80
+PROGRESS_POLL_INTERVAL = 0.5
+PROGRESS_POLL_MAX_INTERVAL = 2
+JOB_STATES_TTL = JOB_TTL_MINUTES * 60
+JOB_STATES_MAX_SIZE = 512
+PROGRESS_RETRY_MS = 1000
+
+# Отдача сохранённых файлов из локального хранилища с поддержкой Range
+# Пока заглушка: загрузка ещё не сохраняет файлы, хранилище (общий том
+# по download_id) подключается через MEDIA_STORAGE_DIR
+MEDIA_STORAGE_DIR = os.environ.get('MEDIA_STORAGE_DIR', '/tmp/media')
+# Лимит тела ответа; тело в base64 на треть больше файла, поэтому
+# за один ответ читается не больше MAX_FILE_SLICE_BYTES
+MAX_FILE_RESPONSE_BYTES = int(os.environ.get('MAX_FILE_RESPONSE_BYTES', str(4 * 1024 * 1024)))
+MAX_FILE_SLICE_BYTES = MAX_FILE_RESPONSE_BYTES // 4 * 3
+RANGE_PATTERN = re.compile(r'^bytes=(\d*)-(\d*)$')
+MEDIA_CONTENT_TYPES = {
+    'video': 'video/mp4',
+    'photo': 'image/jpeg',
+    'document': 'application/octet-stream'
+}
+
+# Последние известные состояния задач в этом контейнере (LRU с TTL)
+_job_states = OrderedDict()
+
 def handler(event: dict, context) -> dict:
     """
     API для скачивания медиа из Telegram каналов.
@@ -18,21 +78,24 @@ def handler(event: dict, context) -> dict:
             'statusCode': 200,
             'headers': {
                 'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type'
+                'Access-Control-Allow-Methods': 'GET, HEAD, POST, OPTIONS',
+                'Access-Control-Allow-Headers': 'Content-Type, Range, If-None-Match, If-Range'
             },
             'body': ''
         }
     
     if method == 'POST':
+        job_id = None
         try:
             body = json.loads(event.get('body', '{}'))
             url = body.get('url', '').strip()
+            job_id = normalize_job_id(body.get('job_id'))
             
             if not url:
                 return error_response('URL не указан', 400)
             
-            if not is_telegram_url(url):
+            link = media_store.parse_telegram_link(url) if is_telegram_url(url) else None
+            if not link:
                 return error_response('Некорректная Telegram ссылка', 400)
             
             bot_token = os.environ.get('TELEGRAM_BOT_TOKEN')
@@ -40,52 +103,92 @@ def handler(event: dict, context) -> dict:
                 return error_response('Токен бота не настроен', 500)
             
             db_conn = get_db_connection()
+            set_job_state(db_conn, job_id, 'queued')
             
-            existing = check_cache(db_conn, url)
+            existing = media_store.find_media(db_conn, *link)
             if existing:
-                update_download_count(db_conn, existing['id'])
+                media_store.touch_media(db_conn, existing.id)
+                set_job_state(db_conn, job_id, 'done',
+                              bytes_done=existing.file_size,
+                              bytes_total=existing.file_size,
+                              download_id=existing.id)
+                read_after = get_write_position(db_conn)
                 db_conn.close()
-                return success_response({
+                return success_response(event, {
                     'cached': True,
-                    'file_url': existing['file_path'],
-                    'thumbnail': existing['thumbnail_url'],
-                    'size': existing['file_size'],
-                    'type': existing['media_type'],
-                    'title': existing['title']
+                    'file_url': existing.file_url,
+                    'thumbnail': existing.thumbnail_url,
+                    'size': existing.file_size,
+                    'type': existing.media_type,
+                    'title': existing.title,
+                    'read_after': read_after
                 })
             
+            set_job_state(db_conn, job_id, 'resolving')
             media_info = extract_telegram_media(url, bot_token)
             
             if not media_info:
+                set_job_state(db_conn, job_id, 'error', error='Не удалось получить медиа')
                 db_conn.close()
                 return error_response('Не удалось получить медиа. Проверьте ссылку или права доступа бота', 400)
             
-            download_id = save_to_database(db_conn, url, media_info)
+            set_job_state(db_conn, job_id, 'transferring',
+                          bytes_done=0, bytes_total=media_info['size'])
+            download_id = media_store.save_media(db_conn, *link, media_info)
+            set_job_state(db_conn, job_id, 'done',
+                          bytes_done=media_info['size'],
+                          bytes_total=media_info['size'],
+                          download_id=download_id)
+            read_after = get_write_position(db_conn)
             db_conn.close()
             
-            return success_response({
+            return success_response(event, {
                 'cached': False,
                 'file_url': media_info['file_url'],
                 'thumbnail': media_info.get('thumbnail'),
                 'size': media_info['size'],
                 'type': media_info['type'],
                 'title': media_info['title'],
-                'download_id': download_id
+                'download_id': download_id,
+                'read_after': read_after
             })
             
         except json.JSONDecodeError:
             return error_response('Некорректный JSON', 400)
         except Exception as e:
+            fail_job(job_id, 'Ошибка сервера')
             return error_response(f'Ошибка сервера: {str(e)}', 500)
     
-    if method == 'GET':
+    if method in ('GET', 'HEAD'):
         try:
-            db_conn = get_db_connection()
+            query_params = event.get('queryStringParameters') or {}
+            
+            if query_params.get('action') == 'file':
+                return handle_file(event, query_params, method == 'HEAD')
+            
+            if query_params.get('action') == 'progress':
+                return handle_progress(event, query_params)
+            
+            compact = query_params.get('format') == 'compact'
+            
+            db_conn = get_read_connection(query_params.get('after'))
+            if compact:
+                rows = fetch_download_history_rows(db_conn)
+                stats_row = fetch_statistics_row(db_conn)
+                db_conn.close()
+                
+                return success_response(event, {
+                    'columns': COMPACT_HISTORY_COLUMNS,
+                    'delta': COMPACT_DELTA_COLUMNS,
+                    'history': compact_history(rows),
+                    'stats': compact_statistics(stats_row)
+                })
+            
             history = get_download_history(db_conn)
             stats = get_statistics(db_conn)
             db_conn.close()
             
-            return success_response({
+            return success_response(event, {
                 'history': history,
                 'stats': stats
             })
@@ -95,72 +198,344 @@ def handler(event: dict, context) -> dict:
     return error_response('Метод не поддерживается', 405)
 
 
-def is_telegram_url(url: str) -> bool:
-    """Проверка валидности Telegram ссылки"""
-    patterns = [
-        r'https?://t\.me/\S+',
-        r'https?://telegram\.me/\S+',
-        r'tg://\S+'
-    ]
-    return any(re.match(pattern, url) for pattern in patterns)
+def handle_progress(event: dict, query_params: dict) -> dict:
+    """
+    Состояние задачи загрузки: long-poll (JSON) или SSE (text/event-stream).
+    Ждёт, пока версия состояния не станет больше известной клиенту.
+    """
+    job_id = normalize_job_id(query_params.get('job_id'))
+    if not job_id:
+        return error_response('Некорректный job_id', 400)
+    
+    sse = 'text/event-stream' in get_header(event, 'Accept') or query_params.get('stream') == 'sse'
+    since = get_header(event, 'Last-Event-ID') if sse else ''
+    since = since or query_params.get('since', '0')
+    try:
+        since_version = int(since)
+    except ValueError:
+        since_version = 0
+    
+    db_conn = get_db_connection()
+    try:
+        job = wait_for_job_state(db_conn, job_id, since_version, time.monotonic() + PROGRESS_WAIT_SECONDS)
+    finally:
+        db_conn.close()
+    
+    if job is None:
+        job = {'job_id': job_id, 'state': 'unknown', 'version': since_version}
+    
+    if sse:
+        return sse_response(job)
+    return success_response(event, job)
 
 
-def get_db_connection():
-    """Подключение к базе данных"""
-    dsn = os.environ.get('DATABASE_URL')
-    conn = psycopg2.connect(dsn)
-    return conn
+def handle_file(event: dict, query_params: dict, head_only: bool) -> dict:
+    """
+    Отдача сохранённого файла с поддержкой Range, ETag и If-None-Match.
+    Читается только запрошенный диапазон через mmap, не больше
+    MAX_FILE_SLICE_BYTES за ответ; клиент докачивает следующими Range.
+    Без Range файл больше лимита не отдаётся (416 с размером в Content-Range),
+    HEAD отвечает теми же заголовками, что и GET.
+    """
+    try:
+        download_id = int(query_params.get('download_id', ''))
+    except ValueError:
+        return error_response('Некорректный download_id', 400)
+    
+    db_conn = get_db_connection()
+    try:
+        media_type = get_stored_media_type(db_conn, download_id)
+    finally:
+        db_conn.close()
+    
+    path = os.path.join(MEDIA_STORAGE_DIR, str(download_id))
+    if media_type is None or not os.path.isfile(path):
+        return error_response('Файл не найден', 404)
+    
+    stat = os.stat(path)
+    size = stat.st_size
+    etag = f'"{size:x}-{stat.st_mtime_ns:x}"'
+    headers = {
+        'Content-Type': MEDIA_CONTENT_TYPES.get(media_type, 'application/octet-stream'),
+        'Accept-Ranges': 'bytes',
+        'ETag': etag,
+        'Cache-Control': 'public, max-age=86400',
+        'Access-Control-Allow-Origin': '*',
+        'Access-Control-Expose-Headers': 'Accept-Ranges, Content-Length, Content-Range, ETag'
+    }
+    
+    if get_header(event, 'If-None-Match') == etag:
+        return {'statusCode': 304, 'headers': headers, 'body': ''}
+    
+    range_header = get_header(event, 'Range')
+    if_range = get_header(event, 'If-Range')
+    if if_range and if_range != etag:
+        range_header = ''
+    
+    byte_range = parse_range(range_header, size)
+    if byte_range is None:
+        headers['Content-Range'] = f'bytes */{size}'
+        return {'statusCode': 416, 'headers': headers, 'body': ''}
+    
+    start, end = byte_range
+    ranged = bool(range_header and RANGE_PATTERN.match(range_header.strip()))
+    if ranged:
+        # Ответ на Range можно укоротить: клиент запросит остаток сам
+        end = min(end, start + MAX_FILE_SLICE_BYTES - 1)
+    elif size > MAX_FILE_SLICE_BYTES:
+        headers['Content-Range'] = f'bytes */{size}'
+        return {'statusCode': 416, 'headers': headers, 'body': ''}
+    partial = ranged and (start > 0 or end < size - 1)
+    
+    if partial:
+        headers['Content-Range'] = f'bytes {start}-{end}/{size}'
+    headers['Content-Length'] = str(end - start + 1 if size else 0)
+    
+    if head_only:
+        return {'statusCode': 206 if partial else 200, 'headers': headers, 'body': ''}
+    
+    return {
+        'statusCode': 206 if partial else 200,
+        'headers': headers,
+        'isBase64Encoded': True,
+        'body': base64.b64encode(read_file_range(path, start, end, size)).decode('ascii')
+    }
 
 
-def check_cache(conn, url: str):
-    """Проверка наличия файла в кэше"""
+def parse_range(range_header: str, size: int):
+    """
+    Разбор заголовка Range (один диапазон) в (start, end) включительно.
+    Без заголовка - весь файл, для недопустимого диапазона - None.
+    """
+    match = RANGE_PATTERN.match(range_header.strip()) if range_header else None
+    if not match:
+        # Отсутствующий, составной или нераспознанный Range игнорируется
+        return 0, max(size - 1, 0)
+    
+    first, last = match.group(1), match.group(2)
+    if not first and not last:
+        return 0, max(size - 1, 0)
+    
+    if not first:
+        suffix = int(last)
+        if suffix == 0:
+            return None
+        return max(size - suffix, 0), size - 1
+    
+    start = int(first)
+    end = int(last) if last else size - 1
+    if start >= size or end < start:
+        return None
+    return start, min(end, size - 1)
+
+
+def read_file_range(path: str, start: int, end: int, size: int) -> bytes:
+    """Чтение диапазона файла через mmap без загрузки всего файла в память"""
+    if not size:
+        return b''
+    
+    with open(path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            return mapped[start:end + 1]
+
+
+def get_stored_media_type(conn, download_id: int):
+    """Тип медиа записи загрузки"""
     schema = os.environ.get('MAIN_DB_SCHEMA', 'public')
     cursor = conn.cursor()
+    
     cursor.execute(f"""
-        SELECT id, file_path, thumbnail_url, file_size, media_type, title
+        SELECT media_type
         FROM {schema}.downloads
-        WHERE url = %s AND cached = true
-        LIMIT 1
-    """, (url,))
+        WHERE id = %s
+    """, (download_id,))
     
     row = cursor.fetchone()
     cursor.close()
     
-    if row:
-        return {
-            'id': row[0],
-            'file_path': row[1],
-            'thumbnail_url': row[2],
-            'file_size': row[3],
-            'media_type': row[4],
-            'title': row[5]
-        }
+    return row[0] if row else None
+
+
+def normalize_job_id(value):
+    """Проверка идентификатора задачи от клиента"""
+    if isinstance(value, str) and JOB_ID_PATTERN.match(value):
+        return value
     return None
 
 
-def update_download_count(conn, download_id: int):
-    """Увеличение счетчика скачиваний"""
+def set_job_state(conn, job_id, state: str, bytes_done: int = None, bytes_total: int = None,
+                  download_id: int = None, error: str = None):
+    """Запись нового состояния задачи загрузки"""
+    if not job_id:
+        return
+    
     schema = os.environ.get('MAIN_DB_SCHEMA', 'public')
     cursor = conn.cursor()
+    
+    if state == 'queued':
+        cursor.execute(f"""
+            DELETE FROM {schema}.download_jobs
+            WHERE updated_at < CURRENT_TIMESTAMP - INTERVAL '{JOB_TTL_MINUTES} minutes'
+        """)
+    
     cursor.execute(f"""
-        UPDATE {schema}.downloads
-        SET download_count = download_count + 1,
+        INSERT INTO {schema}.download_jobs AS job
+            (job_id, state, bytes_done, bytes_total, download_id, error, version, updated_at)
+        VALUES (%s, %s, %s, %s, %s, %s, 1, CURRENT_TIMESTAMP)
+        ON CONFLICT (job_id)
+        DO UPDATE SET
+            state = EXCLUDED.state,
+            bytes_done = EXCLUDED.bytes_done,
+            bytes_total = EXCLUDED.bytes_total,
+            download_id = EXCLUDED.download_id,
+            error = EXCLUDED.error,
+            version = job.version + 1,
             updated_at = CURRENT_TIMESTAMP
-        WHERE id = %s
-    """, (download_id,))
+        RETURNING version
+    """, (job_id, state, bytes_done, bytes_total, download_id, error))
+    
+    version = cursor.fetchone()[0]
     conn.commit()
     cursor.close()
+    
+    remember_job_state(job_state_dict(job_id, state, bytes_done, bytes_total, download_id, error, version))
+
+
+def fail_job(job_id, error: str):
+    """
+    Перевод задачи в 'error' после сбоя обработки на отдельном соединении:
+    соединение запроса могло упасть вместе с ним. Иначе подписчики ждут до TTL.
+    """
+    if not job_id:
+        return
+    
+    try:
+        db_conn = get_db_connection()
+        try:
+            set_job_state(db_conn, job_id, 'error', error=error)
+        finally:
+            db_conn.close()
+    except Exception as e:
+        print(f'Error recording job failure: {str(e)}')
+
+
+def remember_job_state(job: dict):
+    """Сохранение состояния задачи в локальном кэше контейнера"""
+    _job_states[job['job_id']] = (time.monotonic() + JOB_STATES_TTL, job)
+    _job_states.move_to_end(job['job_id'])
+    while len(_job_states) > JOB_STATES_MAX_SIZE:
+        _job_states.popitem(last=False)
+
+
+def recall_job_state(job_id: str):
+    """Состояние задачи из локального кэша, если оно не устарело"""
+    entry = _job_states.get(job_id)
+    if not entry:
+        return None
+    
+    expires_at, job = entry
+    if time.monotonic() >= expires_at:
+        _job_states.pop(job_id, None)
+        return None
+    
+    _job_states.move_to_end(job_id)
+    return job
+
+
+def get_job_state(conn, job_id: str):
+    """Чтение состояния задачи из БД"""
+    schema = os.environ.get('MAIN_DB_SCHEMA', 'public')
+    cursor = conn.cursor()
+    
+    cursor.execute(f"""
+        SELECT state, bytes_done, bytes_total, download_id, error, version
+        FROM {schema}.download_jobs
+        WHERE job_id = %s
+    """, (job_id,))
+    
+    row = cursor.fetchone()
+    conn.commit()
+    cursor.close()
+    
+    if row:
+        return job_state_dict(job_id, *row)
+    return None
+
+
+def wait_for_job_state(conn, job_id: str, since_version: int, deadline: float):
+    """Ожидание изменения состояния задачи до дедлайна"""
+    job = None
+    interval = PROGRESS_POLL_INTERVAL
+    while True:
+        local = recall_job_state(job_id)
+        if local and (local['version'] > since_version or local['state'] in JOB_FINAL_STATES):
+            return local
+        
+        job = get_job_state(conn, job_id)
+        if job and (job['version'] > since_version or job['state'] in JOB_FINAL_STATES):
+            return job
+        
+        remaining = deadline - time.monotonic()
+        if remaining <= 0.05:
+            return job
+        time.sleep(min(interval, remaining))
+        interval = min(interval * 2, PROGRESS_POLL_MAX_INTERVAL)
+
+
+def job_state_dict(job_id: str, state: str, bytes_done, bytes_total, download_id, error, version: int) -> dict:
+    """Состояние задачи в формате ответа"""
+    return {
+        'job_id': job_id,
+        'state': state,
+        'bytes_done': bytes_done,
+        'bytes_total': bytes_total,
+        'download_id': download_id,
+        'error': error,
+        'version': version
+    }
+
+
+def is_telegram_url(url: str) -> bool:
+    """Проверка валидности Telegram ссылки"""
+    patterns = [
+        r'https?://t\.me/\S+',
+        r'https?://telegram\.me/\S+',
+        r'tg://\S+'
+    ]
+    return any(re.match(pattern, url) for pattern in patterns)
+
+
+def get_db_connection():
+    """Подключение к базе данных"""
+    dsn = os.environ.get('DATABASE_URL')
+    return media_store.connect(dsn)
+
+
+def get_read_connection(after_lsn: str = None):
+    """Подключение для чтения истории и статистики: реплика, если она догнала after_lsn"""
+    return media_store.connect_read(
+        os.environ.get('DATABASE_URL'),
+        os.environ.get('DATABASE_REPLICA_URL'),
+        after_lsn
+    )
+
+
+def get_write_position(conn):
+    """Позиция WAL после записи для чтения своих записей с реплики; без реплики не нужна"""
+    if not os.environ.get('DATABASE_REPLICA_URL'):
+        return None
+    return media_store.current_lsn(conn)
 
 
 def extract_telegram_media(url: str, bot_token: str):
     """Извлечение медиа из Telegram через Bot API"""
     
-    message_id = extract_message_id(url)
-    channel = extract_channel(url)
-    
-    if not message_id or not channel:
+    link = media_store.parse_telegram_link(url)
+    if not link:
         return None
     
+    channel, message_id = link
+    
     api_url = f"https://api.telegram.org/bot{bot_token}/getUpdates"
     
     try:
@@ -173,7 +548,7 @@ def extract_telegram_media(url: str, bot_token: str):
         return {
             'type': 'video',
             'title': title,
-            'file_url': f"https://t.me/{channel}/{message_id}",
+            'file_url': media_store.canonical_url(channel, message_id),
             'thumbnail': 'https://images.unsplash.com/photo-1611162617474-5b21e879e113?w=400',
             'size': 1024000
         }
@@ -182,53 +557,16 @@ def extract_telegram_media(url: str, bot_token: str):
         return None
 
 
-def extract_message_id(url: str):
-    """Извлечение ID сообщения из URL"""
-    match = re.search(r'/(\d+)(?:\?|$)', url)
-    return match.group(1) if match else None
-
-
-def extract_channel(url: str):
-    """Извлечение имени канала из URL"""
-    match = re.search(r't\.me/([^/\?]+)', url)
-    return match.group(1) if match else 'unknown'
-
-
-def save_to_database(conn, url: str, media_info: dict) -> int:
-    """Сохранение информации о загрузке в БД"""
-    schema = os.environ.get('MAIN_DB_SCHEMA', 'public')
-    cursor = conn.cursor()
-    
-    cursor.execute(f"""
-        INSERT INTO {schema}.downloads (url, media_type, title, file_path, file_size, thumbnail_url, cached)
-        VALUES (%s, %s, %s, %s, %s, %s, %s)
-        RETURNING id
-    """, (
-        url,
-        media_info['type'],
-        media_info['title'],
-        media_info['file_url'],
-        media_info['size'],
-        media_info.get('thumbnail'),
-        True
-    ))
-    
-    download_id = cursor.fetchone()[0]
-    conn.commit()
-    cursor.close()
-    
-    return download_id
-
-
-def get_download_history(conn, limit: int = 20):
-    """Получение истории загрузок"""
+def fetch_download_history_rows(conn, limit: int = 20):
+    """Получение сырых строк истории загрузок"""
     schema = os.environ.get('MAIN_DB_SCHEMA', 'public')
     cursor = conn.cursor()
     
     cursor.execute(f"""
-        SELECT id, url, media_type, title, file_path, file_size, 
+        SELECT id, url, media_type, title, file_url, file_size, 
                thumbnail_url, cached, download_count, created_at
         FROM {schema}.downloads
+        WHERE download_count > 0
         ORDER BY created_at DESC
         LIMIT %s
     """, (limit,))
@@ -236,26 +574,60 @@ def get_download_history(conn, limit: int = 20):
     rows = cursor.fetchall()
     cursor.close()
     
+    return rows
+
+
+def get_download_history(conn, limit: int = 20):
+    """Получение истории загрузок"""
+    rows = fetch_download_history_rows(conn, limit)
+    return [format_history_row(row) for row in rows]
+
+
+def format_history_row(row) -> dict:
+    """Строка истории с размером и датой в читаемом виде"""
+    return {
+        'id': str(row[0]),
+        'url': row[1],
+        'type': row[2],
+        'title': row[3],
+        'file_path': row[4],
+        'size': format_file_size(row[5]) if row[5] else 'N/A',
+        'thumbnail': row[6],
+        'cached': row[7],
+        'download_count': row[8],
+        'date': format_date(row[9])
+    }
+
+
+def compact_history(rows) -> list:
+    """
+    История без форматирования: числа вместо строк, дата в unix-времени.
+    id и created_at - разность с предыдущей строкой (первая строка - абсолютные).
+    """
     history = []
+    previous_id = 0
+    previous_ts = 0
     for row in rows:
-        history.append({
-            'id': str(row[0]),
-            'url': row[1],
-            'type': row[2],
-            'title': row[3],
-            'file_path': row[4],
-            'size': format_file_size(row[5]) if row[5] else 'N/A',
-            'thumbnail': row[6],
-            'cached': row[7],
-            'download_count': row[8],
-            'date': format_date(row[9])
-        })
-    
+        ts = int(row[9].timestamp()) if row[9] else previous_ts
+        history.append([
+            row[0] - previous_id,
+            row[1],
+            row[2],
+            row[3],
+            None if row[4] == row[1] else row[4],
+            row[5],
+            row[6],
+            row[7],
+            row[8],
+            ts - previous_ts
+        ])
+        previous_id = row[0]
+        previous_ts = ts
     return history
 
 
-def get_statistics(conn):
-    """Получение статистики"""
+def fetch_statistics_row(conn):
+    """Получение сырой строки статистики"""
     schema = os.environ.get('MAIN_DB_SCHEMA', 'public')
     cursor = conn.cursor()
     
@@ -266,11 +638,22 @@ def get_statistics(conn):
             COALESCE(SUM(file_size), 0) as total_size,
             COALESCE(SUM(download_count), 0) as total_download_count
         FROM {schema}.downloads
+        WHERE download_count > 0
     """)
     
     row = cursor.fetchone()
     cursor.close()
     
+    return row
+
+
+def get_statistics(conn):
+    """Получение статистики"""
+    return format_statistics(fetch_statistics_row(conn))
+
+
+def format_statistics(row) -> dict:
+    """Статистика с размером в читаемом виде"""
     return {
         'totalDownloads': row[3] or 0,
         'cachedFiles': row[1] or 0,
@@ -279,6 +662,16 @@ def get_statistics(conn):
     }
 
 
+def compact_statistics(row) -> dict:
+    """Статистика без форматирования: размер в байтах"""
+    return {
+        'totalDownloads': int(row[3] or 0),
+        'cachedFiles': row[1] or 0,
+        'savedBytes': int(row[2] or 0),
+        'activeUsers': row[0] or 0
+    }
+
+
 def format_file_size(size_bytes: int) -> str:
     """Форматирование размера файла"""
     if size_bytes < 1024:
@@ -309,15 +702,106 @@ def format_date(dt: datetime) -> str:
         return dt.strftime("%d.%m.%Y")
 
 
-def success_response(data: dict):
-    """Успешный ответ"""
+def get_header(event: dict, name: str) -> str:
+    """Получение заголовка запроса без учёта регистра"""
+    headers = (event or {}).get('headers') or {}
+    name = name.lower()
+    for key, value in headers.items():
+        if key.lower() == name:
+            return value or ''
+    return ''
+
+
+def encode_json(data) -> bytes:
+    """Сериализация в JSON через orjson, если он установлен"""
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def choose_encoding(accept_encoding: str):
+    """Выбор алгоритма сжатия по заголовку Accept-Encoding"""
+    accepted = {}
+    for part in accept_encoding.split(','):
+        token, _, params = part.strip().partition(';')
+        token = token.strip().lower()
+        if not token:
+            continue
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[token] = quality
+    
+    def allowed(encoding: str) -> bool:
+        return accepted.get(encoding, accepted.get('*', 0.0)) > 0
+    
+    if brotli is not None and allowed('br'):
+        return 'br'
+    if allowed('gzip'):
+        return 'gzip'
+    return None
+
+
+def compress_body(raw: bytes, encoding: str) -> bytes:
+    """Сжатие тела ответа выбранным алгоритмом"""
+    if encoding == 'br':
+        return brotli.compress(raw, quality=BROTLI_QUALITY)
+    return gzip.compress(raw, compresslevel=GZIP_LEVEL)
+
+
+def success_response(event: dict, data: dict):
+    """Успешный ответ со сжатием по Accept-Encoding"""
+    raw = encode_json(data)
+    headers = {
+        'Content-Type': 'application/json; charset=utf-8',
+        'Access-Control-Allow-Origin': '*',
+        'Vary': 'Accept-Encoding'
+    }
+    
+    encoding = None
+    if len(raw) >= MIN_COMPRESS_SIZE:
+        encoding = choose_encoding(get_header(event, 'Accept-Encoding'))
+    
+    if encoding:
+        headers['Content-Encoding'] = encoding
+        return {
+            'statusCode': 200,
+            'headers': headers,
+            'isBase64Encoded': True,
+            'body': base64.b64encode(compress_body(raw, encoding)).decode('ascii')
+        }
+    
+    return {
+        'statusCode': 200,
+        'headers': headers,
+        'body': raw.decode('utf-8')
+    }
+
+
+def sse_response(job: dict):
+    """
+    Одно SSE-событие с состоянием задачи.
+    Функция завершается после события, EventSource переподключается
+    через retry и передаёт версию в Last-Event-ID.
+    """
+    lines = [f"retry: {PROGRESS_RETRY_MS}"]
+    if job['state'] != 'unknown':
+        lines.append(f"id: {job['version']}")
+    lines.append(f"event: {'end' if job['state'] in JOB_FINAL_STATES else 'progress'}")
+    lines.append(f"data: {encode_json(job).decode('utf-8')}")
+    
     return {
         'statusCode': 200,
         'headers': {
-            'Content-Type': 'application/json',
+            'Content-Type': 'text/event-stream; charset=utf-8',
+            'Cache-Control': 'no-cache',
             'Access-Control-Allow-Origin': '*'
         },
-        'body': json.dumps(data, ensure_ascii=False)
+        'body': '\n'.join(lines) + '\n\n'
     }
 
 
@@ -0,0 +1,289 @@
+"""
+Общий слой доступа к кэшу медиа (таблица downloads).
+Используется функциями download и telegram-bot; файл одинаковый в обеих
+папках, так как функции деплоятся независимо.
+
+Ключ кэша - пост канала (channel, message_id).
+file_id - идентификатор файла в Telegram для основного бота, file_url - ссылка
+для веба. file_id не переносится между ботами, для остальных ботов пула
+они хранятся в bot_file_ids.
+"""
+import os
+import re
+import time
+import psycopg2
+
+# Ссылки вида t.me/channel/123, t.me/s/channel/123 и t.me/c/1234567890/123
+TELEGRAM_LINK_PATTERN = re.compile(
+    r'(?:t\.me|telegram\.me)/(?:(c)/(\d+)|(?:s/)?([A-Za-z0-9_]+))/(\d+)'
+)
+
+# Реплика для чтения: таймаут подключения и пауза после её недоступности
+REPLICA_CONNECT_TIMEOUT = 2
+REPLICA_RETRY_SECONDS = 30
+LSN_PATTERN = re.compile(r'^[0-9A-Fa-f]{1,8}/[0-9A-Fa-f]{1,8}$')
+
+_replica_down_until = 0.0
+_schema_statements = {}
+
+# Горячие запросы. Без серверного PREPARE: соединение живёт один вызов функции
+# и выполняет каждый запрос обычно один раз, PREPARE лишь удваивал обращения к БД
+STATEMENTS = {
+    'media_lookup': """
+        SELECT id, file_id, file_url, thumbnail_url, file_size, media_type, title
+        FROM {schema}.downloads
+        WHERE channel = %s AND message_id = %s AND cached = true
+        LIMIT 1
+    """,
+    'media_touch': """
+        UPDATE {schema}.downloads
+        SET download_count = download_count + 1,
+            updated_at = CURRENT_TIMESTAMP
+        WHERE id = %s
+    """,
+    'media_upsert': """
+        INSERT INTO {schema}.downloads AS download
+            (url, channel, message_id, media_type, title, file_id, file_url,
+             file_size, thumbnail_url, cached, download_count)
+        VALUES (%(url)s, %(channel)s, %(message_id)s, %(media_type)s, %(title)s, %(file_id)s,
+                %(file_url)s, %(file_size)s, %(thumbnail_url)s, true, %(count)s)
+        ON CONFLICT (channel, message_id)
+        DO UPDATE SET
+            media_type = CASE WHEN %(known)s THEN EXCLUDED.media_type ELSE download.media_type END,
+            title = CASE WHEN %(known)s THEN EXCLUDED.title ELSE download.title END,
+            file_id = COALESCE(EXCLUDED.file_id, download.file_id),
+            file_url = COALESCE(EXCLUDED.file_url, download.file_url),
+            file_size = COALESCE(EXCLUDED.file_size, download.file_size),
+            thumbnail_url = COALESCE(EXCLUDED.thumbnail_url, download.thumbnail_url),
+            cached = true,
+            download_count = download.download_count + EXCLUDED.download_count,
+            updated_at = CURRENT_TIMESTAMP
+        RETURNING id
+    """,
+    'media_invalidate': """
+        UPDATE {schema}.downloads
+        SET cached = false,
+            file_id = NULL,
+            updated_at = CURRENT_TIMESTAMP
+        WHERE id = %s
+    """,
+    'media_invalidate_post': """
+        UPDATE {schema}.downloads
+        SET cached = false,
+            file_id = NULL,
+            updated_at = CURRENT_TIMESTAMP
+        WHERE channel = %s AND message_id = %s
+    """,
+    'bot_file_lookup': """
+        SELECT file_id
+        FROM {schema}.bot_file_ids
+        WHERE download_id = %s AND bot_id = %s
+    """,
+    'bot_file_upsert': """
+        INSERT INTO {schema}.bot_file_ids (download_id, bot_id, file_id)
+        VALUES (%s, %s, %s)
+        ON CONFLICT (download_id, bot_id)
+        DO UPDATE SET
+            file_id = EXCLUDED.file_id,
+            updated_at = CURRENT_TIMESTAMP
+    """,
+    'bot_file_delete': """
+        DELETE FROM {schema}.bot_file_ids
+        WHERE download_id = %s AND bot_id = %s
+    """
+}
+
+
+class MediaRow:
+    """Запись кэша медиа"""
+    __slots__ = ('id', 'file_id', 'file_url', 'thumbnail_url', 'file_size', 'media_type', 'title')
+
+    def __init__(self, id, file_id, file_url, thumbnail_url, file_size, media_type, title):
+        self.id = id
+        self.file_id = file_id
+        self.file_url = file_url
+        self.thumbnail_url = thumbnail_url
+        self.file_size = file_size
+        self.media_type = media_type
+        self.title = title
+
+
+def connect(dsn: str, **kwargs):
+    """Подключение к базе данных"""
+    return psycopg2.connect(dsn, **kwargs)
+
+
+def connect_read(primary_dsn: str, replica_dsn: str = None, after_lsn: str = None):
+    """
+    Подключение для запросов только на чтение.
+    Идёт на реплику, если она задана, доступна и уже применила after_lsn
+    (позиция WAL после записи этого клиента); иначе на основную базу.
+    """
+    global _replica_down_until
+
+    if replica_dsn and time.monotonic() >= _replica_down_until:
+        try:
+            conn = connect(replica_dsn, connect_timeout=REPLICA_CONNECT_TIMEOUT)
+        except psycopg2.OperationalError as e:
+            print(f'Replica unavailable, reading from primary: {str(e)}')
+            _replica_down_until = time.monotonic() + REPLICA_RETRY_SECONDS
+        else:
+            if not after_lsn or replica_caught_up(conn, after_lsn):
+                return conn
+            conn.close()
+
+    return connect(primary_dsn)
+
+
+def replica_caught_up(conn, lsn: str) -> bool:
+    """Проверка, что реплика применила WAL до позиции lsn"""
+    if not LSN_PATTERN.match(lsn):
+        return False
+
+    cursor = conn.cursor()
+    cursor.execute("SELECT pg_last_wal_replay_lsn() >= %s::pg_lsn", (lsn,))
+    caught_up = cursor.fetchone()[0]
+    conn.commit()
+    cursor.close()
+
+    return bool(caught_up)
+
+
+def current_lsn(conn) -> str:
+    """Текущая позиция WAL основной базы: метка для чтения своих записей"""
+    cursor = conn.cursor()
+    cursor.execute("SELECT pg_current_wal_lsn()::text")
+    lsn = cursor.fetchone()[0]
+    conn.commit()
+    cursor.close()
+
+    return lsn
+
+
+def statement(name: str) -> str:
+    """Текст запроса из STATEMENTS для MAIN_DB_SCHEMA, собирается один раз на схему"""
+    schema = os.environ.get('MAIN_DB_SCHEMA', 'public')
+    statements = _schema_statements.get(schema)
+    if statements is None:
+        statements = {key: sql.format(schema=schema) for key, sql in STATEMENTS.items()}
+        _schema_statements[schema] = statements
+    return statements[name]
+
+
+def execute(cursor, name: str, params=()):
+    """Выполнение запроса из STATEMENTS"""
+    cursor.execute(statement(name), params)
+
+
+def parse_telegram_link(url: str):
+    """Канонический ключ поста (channel, message_id) из ссылки"""
+    match = TELEGRAM_LINK_PATTERN.search(url)
+    if not match:
+        return None
+
+    if match.group(1):
+        channel = f'-100{match.group(2)}'
+    else:
+        channel = match.group(3).lower()
+
+    return channel, int(match.group(4))
+
+
+def canonical_url(channel: str, message_id: int) -> str:
+    """Каноническая ссылка на пост"""
+    if channel.startswith('-100'):
+        return f'https://t.me/c/{channel[4:]}/{message_id}'
+    return f'https://t.me/{channel}/{message_id}'
+
+
+def find_media(conn, channel: str, message_id: int):
+    """Поиск закэшированного медиа по посту"""
+    cursor = conn.cursor()
+    execute(cursor, 'media_lookup', (channel, message_id))
+    row = cursor.fetchone()
+    conn.commit()
+    cursor.close()
+
+    return MediaRow(*row) if row else None
+
+
+def touch_media(conn, download_id: int):
+    """Увеличение счетчика скачиваний"""
+    cursor = conn.cursor()
+    execute(cursor, 'media_touch', (download_id,))
+    conn.commit()
+    cursor.close()
+
+
+def save_media(conn, channel: str, message_id: int, media_info: dict, count: int = 1,
+               shared_file_id: bool = True) -> int:
+    """
+    Сохранение медиа поста в кэш.
+    count=0 - индексация без скачивания, пустые поля не затирают известные.
+    Тип и название обновляются только при известном file_id: без него media_info -
+    заглушка по ссылке. shared_file_id=False - file_id другого бота пула,
+    в downloads он не пишется.
+    """
+    cursor = conn.cursor()
+    execute(cursor, 'media_upsert', {
+        'url': canonical_url(channel, message_id),
+        'channel': channel,
+        'message_id': message_id,
+        'media_type': media_info['type'],
+        'title': media_info['title'],
+        'file_id': media_info.get('file_id') if shared_file_id else None,
+        'file_url': media_info.get('file_url') or canonical_url(channel, message_id),
+        'file_size': media_info.get('size'),
+        'thumbnail_url': media_info.get('thumbnail'),
+        'count': count,
+        'known': bool(media_info.get('file_id'))
+    })
+
+    download_id = cursor.fetchone()[0]
+    conn.commit()
+    cursor.close()
+
+    return download_id
+
+
+def invalidate_media(conn, download_id: int):
+    """Снятие записи из кэша"""
+    cursor = conn.cursor()
+    execute(cursor, 'media_invalidate', (download_id,))
+    conn.commit()
+    cursor.close()
+
+
+def invalidate_post(conn, channel: str, message_id: int):
+    """Снятие поста канала из кэша"""
+    cursor = conn.cursor()
+    execute(cursor, 'media_invalidate_post', (channel, message_id))
+    conn.commit()
+    cursor.close()
+
+
+def find_bot_file_id(conn, download_id: int, bot_id: int):
+    """file_id медиа для бота пула"""
+    cursor = conn.cursor()
+    execute(cursor, 'bot_file_lookup', (download_id, bot_id))
+    row = cursor.fetchone()
+    conn.commit()
+    cursor.close()
+
+    return row[0] if row else None
+
+
+def save_bot_file_id(conn, download_id: int, bot_id: int, file_id: str):
+    """Сохранение file_id медиа для бота пула"""
+    cursor = conn.cursor()
+    execute(cursor, 'bot_file_upsert', (download_id, bot_id, file_id))
+    conn.commit()
+    cursor.close()
+
+
+def delete_bot_file_id(conn, download_id: int, bot_id: int):
+    """Удаление недействительного file_id бота пула"""
+    cursor = conn.cursor()
+    execute(cursor, 'bot_file_delete', (download_id, bot_id))
+    conn.commit()
+    cursor.close()
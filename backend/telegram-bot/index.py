@@ -1,15 +1,107 @@
 import json
 import os
-import psycopg2
+import random
+import re
+import time
 import requests
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from datetime import datetime
+from urllib3.exceptions import NewConnectionError
+
+import media_store
+
+# Лимиты запросов: (запросов в минуту, размер всплеска)
+USER_RATE_LIMIT = (
+    float(os.environ.get('RATE_LIMIT_USER_PER_MINUTE', '10')),
+    float(os.environ.get('RATE_LIMIT_USER_BURST', '5'))
+)
+CHAT_RATE_LIMIT = (
+    float(os.environ.get('RATE_LIMIT_CHAT_PER_MINUTE', '30')),
+    float(os.environ.get('RATE_LIMIT_CHAT_BURST', '10'))
+)
+RATE_LIMIT_SHARED = os.environ.get('RATE_LIMIT_SHARED', '1') == '1'
+RATE_LIMIT_TTL_MINUTES = 60
+RATE_LIMIT_CLEANUP_PROBABILITY = 0.01
+
+# Повторные одинаковые ссылки отдаются из памяти без запроса к кэшу в БД
+LINK_MEMO_TTL = 30
+LINK_MEMO_MAX_SIZE = 1024
+LOCAL_BUCKETS_MAX_SIZE = 10000
+
+# Ответы Bot API на недействительный file_id: только после них запись кэша сбрасывается
+FILE_ID_ERROR_MARKERS = ('file identifier', 'file_id', 'file reference')
+MARKDOWN_SPECIAL_PATTERN = re.compile(r'([_*`\[])')
+
+# Повторные доставки одного обновления (bot_id, update_id): окно в памяти и таблица processed_updates
+RECENT_UPDATES_MAX_SIZE = 5000
+PROCESSED_UPDATES_TTL_HOURS = 24
+PROCESSED_UPDATES_CLEANUP_PROBABILITY = 0.01
+
+# Inline-поиск по кэшу: результаты популярных запросов держатся в памяти
+INLINE_RESULTS_LIMIT = 20
+INLINE_QUERY_MAX_LENGTH = 64
+INLINE_CACHE_TTL = 60
+INLINE_CACHE_MAX_SIZE = 256
+INLINE_ANSWER_CACHE_TIME = 300
+INLINE_RESULT_TYPES = {
+    'photo': 'photo_file_id',
+    'video': 'video_file_id',
+    'document': 'document_file_id'
+}
+
+# Пул ботов: TELEGRAM_BOT_TOKENS через запятую, первый - основной.
+# Лимит отправки и здоровье считаются отдельно для каждого токена
+BOT_SEND_RATE = float(os.environ.get('BOT_SEND_RATE_PER_SECOND', '25'))
+BOT_SEND_BURST = float(os.environ.get('BOT_SEND_BURST', '30'))
+BOT_MAX_PACING_WAIT = 1.0
+BOT_FAILURES_TO_UNHEALTHY = 3
+BOT_UNHEALTHY_SECONDS = 30
+
+# Хвостовые задержки Bot API: дедлайн обновления, повторы с джиттером,
+# хеджирование идемпотентных запросов
+TELEGRAM_API_BASE = os.environ.get('TELEGRAM_API_BASE', 'https://api.telegram.org')
+TELEGRAM_STORAGE_CHAT_ID = os.environ.get('TELEGRAM_STORAGE_CHAT_ID')
+UPDATE_DEADLINE_SECONDS = float(os.environ.get('UPDATE_DEADLINE_SECONDS', '25'))
+DEADLINE_RESERVE_SECONDS = 1.0
+MIN_CALL_TIMEOUT = 0.3
+CALL_MAX_ATTEMPTS = 3
+RETRY_BASE_DELAY = 0.2
+RETRY_MAX_DELAY = 2.0
+HEDGE_DELAY = float(os.environ.get('TELEGRAM_HEDGE_DELAY', '1.5'))
+HEDGE_MAX_REQUESTS = 3
+TRY_LATER_TIMEOUT = 2
+TRY_LATER_INTERVAL = 60
+
+# Состояние контейнера: локальные бакеты, мемо ссылок, окно update_id и счётчики
+_local_buckets = {}
+_link_memo = {}
+_inline_cache = OrderedDict()
+_bot_states = {}
+_try_later_sent = {}
+_call_metrics = {'retries': 0, 'hedges': 0, 'circuit_rejections': 0, 'deadline_exceeded': 0}
+# Проигравшие хеджированные запросы досиживают до своего таймаута в пуле,
+# поэтому потоков с запасом: иначе новый хедж встаёт в очередь за ними
+_hedge_executor = ThreadPoolExecutor(max_workers=16)
+_request_deadline = None
+_recent_updates = set()
+_recent_updates_order = deque()
+_throttle_metrics = {'admitted': 0, 'rejected': 0, 'memo_hits': 0}
+_update_metrics = {'duplicates': 0}
+
+class TelegramUnavailable(Exception):
+    """Bot API недоступен: открыт предохранитель или истёк дедлайн обновления"""
+
 
 def handler(event: dict, context) -> dict:
     """
     Telegram Bot webhook для обработки сообщений.
     Поддерживает команды и автоматическое скачивание медиа по ссылкам.
     """
+    global _request_deadline
+    
     method = event.get('httpMethod', 'POST')
+    _request_deadline = time.monotonic() + UPDATE_DEADLINE_SECONDS
     
     if method == 'OPTIONS':
         return cors_response()
@@ -18,6 +110,32 @@ def handler(event: dict, context) -> dict:
         try:
             body = json.loads(event.get('body', '{}'))
             
+            # Отвечает тот бот пула, которому пришло обновление:
+            # чаты, file_id и нумерация update_id привязаны к конкретному боту
+            bot_token = select_bot(event)
+            if not bot_token:
+                return error_response('Токен бота не настроен', 500)
+            
+            update_key = (bot_id(bot_token), body.get('update_id'))
+            if update_key in _recent_updates:
+                _update_metrics['duplicates'] += 1
+                return success_response({'ok': True})
+            
+            channel_post = body.get('channel_post') or body.get('edited_channel_post')
+            if channel_post:
+                db_conn = get_db_connection()
+                if claim_update(db_conn, update_key):
+                    handle_channel_post(db_conn, channel_post, 'edited_channel_post' in body, bot_token)
+                db_conn.close()
+                return success_response({'ok': True})
+            
+            inline_query = body.get('inline_query')
+            if inline_query:
+                # Ответ на inline-запрос идемпотентен, поэтому без захвата update_id в БД
+                remember_update(update_key)
+                handle_inline_query(inline_query, bot_token)
+                return success_response({'ok': True})
+            
             if 'message' not in body:
                 return success_response({'ok': True})
             
@@ -26,26 +144,47 @@ def handler(event: dict, context) -> dict:
             text = message.get('text', '')
             user = message.get('from', {})
             
-            bot_token = os.environ.get('TELEGRAM_BOT_TOKEN')
-            if not bot_token:
-                return error_response('Токен бота не настроен', 500)
+            limits = [(f"user:{user.get('id')}", USER_RATE_LIMIT), (f'chat:{chat_id}', CHAT_RATE_LIMIT)]
+            if not take_local_tokens(limits):
+                record_throttle(False)
+                return success_response({'ok': True})
+            
+            if not bot_available(bot_token):
+                _call_metrics['circuit_rejections'] += 1
+                send_try_later(chat_id, bot_token)
+                return success_response({'ok': True})
             
             db_conn = get_db_connection()
+            
+            if not claim_update(db_conn, update_key):
+                db_conn.close()
+                return success_response({'ok': True})
+            
+            if RATE_LIMIT_SHARED and not take_shared_tokens(db_conn, limits):
+                record_throttle(False)
+                db_conn.close()
+                return success_response({'ok': True})
+            record_throttle(True)
+            
             save_or_update_user(db_conn, user)
             
-            if text.startswith('/'):
-                handle_command(chat_id, text, bot_token, db_conn)
-            elif is_telegram_url(text):
-                handle_download(chat_id, text, bot_token, db_conn, user['id'])
-            else:
-                send_message(chat_id, 
-                    '👋 Отправь мне ссылку на видео или фото из Telegram канала!\n\n'
-                    '📝 Или используй команды:\n'
-                    '/start - начать работу\n'
-                    '/help - помощь\n'
-                    '/stats - статистика',
-                    bot_token
-                )
+            try:
+                if text.startswith('/'):
+                    handle_command(chat_id, text, bot_token, db_conn)
+                elif is_telegram_url(text):
+                    handle_download(chat_id, text, bot_token, db_conn, user['id'])
+                else:
+                    send_message(chat_id, 
+                        '👋 Отправь мне ссылку на видео или фото из Telegram канала!\n\n'
+                        '📝 Или используй команды:\n'
+                        '/start - начать работу\n'
+                        '/help - помощь\n'
+                        '/stats - статистика',
+                        bot_token
+                    )
+            except TelegramUnavailable as e:
+                print(f'Telegram unavailable: {str(e)}')
+                send_try_later(chat_id, bot_token)
             
             db_conn.close()
             return success_response({'ok': True})
@@ -55,22 +194,37 @@ def handler(event: dict, context) -> dict:
             return success_response({'ok': True})
     
     if method == 'GET':
-        query_params = event.get('queryStringParameters', {})
+        query_params = event.get('queryStringParameters') or {}
         action = query_params.get('action', '')
         
         if action == 'set_webhook':
-            bot_token = os.environ.get('TELEGRAM_BOT_TOKEN')
             webhook_url = query_params.get('url', '')
             
             if not webhook_url:
                 return error_response('URL не указан', 400)
             
-            result = set_webhook(bot_token, webhook_url)
-            return success_response(result)
+            separator = '&' if '?' in webhook_url else '?'
+            results = {
+                str(bot_id(token)): set_webhook(token, f'{webhook_url}{separator}bot={bot_id(token)}')
+                for token in get_bot_pool()
+            }
+            return success_response({
+                'ok': bool(results) and all(result.get('ok') for result in results.values()),
+                'results': results
+            })
+        
+        if action == 'metrics':
+            return success_response({
+                'throttle': _throttle_metrics,
+                'updates': _update_metrics,
+                'bots': bot_metrics(),
+                'calls': _call_metrics
+            })
         
         return success_response({
             'status': 'active',
-            'bot': 'TG Media Downloader Bot'
+            'bot': 'TG Media Downloader Bot',
+            'pool_size': len(get_bot_pool())
         })
     
     return error_response('Метод не поддерживается', 405)
@@ -124,12 +278,19 @@ def handle_command(chat_id: int, text: str, bot_token: str, db_conn):
         
         row = cursor.fetchone()
         user_downloads = row[0] if row else 0
+        cursor.close()
+        
+        # Счётчик пользователя только что записан - читаем с основной базы,
+        # общая статистика терпит отставание реплики
+        read_conn = get_read_connection()
+        cursor = read_conn.cursor()
         
         cursor.execute(f"""
             SELECT 
                 COUNT(*) as total,
                 COUNT(*) FILTER (WHERE cached = true) as cached
             FROM {schema}.downloads
+            WHERE download_count > 0
         """)
         
         stats = cursor.fetchone()
@@ -137,6 +298,7 @@ def handle_command(chat_id: int, text: str, bot_token: str, db_conn):
         cached_files = stats[1] if stats else 0
         
         cursor.close()
+        read_conn.close()
         
         send_message(chat_id,
             f'📊 *Твоя статистика:*\n\n'
@@ -158,35 +320,601 @@ def handle_command(chat_id: int, text: str, bot_token: str, db_conn):
 def handle_download(chat_id: int, url: str, bot_token: str, db_conn, user_id: int):
     """Обработка запроса на скачивание"""
     
+    link = media_store.parse_telegram_link(url)
+    memo_key = (bot_id(bot_token),) + link if link else None
+    existing = None
+    if link:
+        existing = memo_get(memo_key)
+        if existing:
+            _throttle_metrics['memo_hits'] += 1
+        else:
+            existing = media_store.find_media(db_conn, *link)
+            if existing:
+                existing = media_for_bot(db_conn, existing, bot_token)
+    
+    if existing and existing.file_id:
+        result = send_cached_media(chat_id, existing, bot_token)
+        
+        if result and result.get('ok'):
+            memo_put(memo_key, existing)
+            media_store.touch_media(db_conn, existing.id)
+            update_user_downloads(db_conn, user_id, existing.id)
+            return
+        
+        if not result or result.get('error_code') != 400:
+            # 429 или сбой Telegram: кэш не трогаем, пересылка упрётся в тот же лимит
+            send_try_later(chat_id, bot_token)
+            return
+        
+        _link_memo.pop(memo_key, None)
+        if is_file_id_error(result):
+            # file_id больше не работает (пост удалён или файл заменён)
+            forget_file_id(db_conn, existing.id, bot_token)
+        else:
+            print(f"Cached send rejected: {result.get('description')}")
+    
     send_message(chat_id, '⏳ Получаю файл из Telegram...', bot_token)
     
-    existing = check_cache(db_conn, url)
+    media_info = get_telegram_file(url, bot_token, chat_id) if link else None
     
-    if existing and existing.get('file_id'):
-        update_download_count(db_conn, existing['id'])
-        update_user_downloads(db_conn, user_id, existing['id'])
+    if media_info:
+        download_id = store_media(db_conn, link, media_info, bot_token)
+        update_user_downloads(db_conn, user_id, download_id)
+        memo_put(memo_key, media_store.MediaRow(
+            download_id,
+            media_info['file_id'],
+            media_info['file_url'],
+            media_info.get('thumbnail'),
+            media_info.get('size', 0),
+            media_info['type'],
+            media_info['title']
+        ))
         
-        send_cached_media(chat_id, existing, bot_token)
+        send_downloaded_media(chat_id, media_info, bot_token)
+    else:
+        send_message(chat_id,
+            '❌ *Ошибка загрузки*\n\n'
+            'Не удалось получить медиа. Возможные причины:\n'
+            '• Неверная ссылка\n'
+            '• Канал недоступен\n'
+            '• Бот не добавлен в канал\n'
+            '• Файл удалён\n\n'
+            '💡 Добавь бота в канал как администратора для доступа к файлам!',
+            bot_token,
+            parse_mode='Markdown'
+        )
+
+
+def handle_channel_post(db_conn, post: dict, edited: bool, bot_token: str):
+    """
+    Предварительная индексация медиа из каналов, где бот администратор.
+    Первый запрос пользователя к посту сразу попадает в кэш.
+    """
+    chat = post.get('chat', {})
+    message_id = post.get('message_id')
+    if not message_id or not chat.get('id'):
+        return
+    
+    username = chat.get('username')
+    channel = username.lower() if username else str(chat['id'])
+    
+    media_info = extract_message_media(post, username or chat.get('title') or channel)
+    
+    if media_info:
+        store_media(db_conn, (channel, message_id), media_info, bot_token, count=0)
+    elif edited:
+        # Медиа убрали из поста при редактировании
+        media_store.invalidate_post(db_conn, channel, message_id)
+
+
+def handle_inline_query(inline_query: dict, bot_token: str):
+    """
+    Inline-режим: поиск по каналу или названию среди закэшированных медиа.
+    Отвечает InlineQueryResultCached* с file_id, без forwardMessage.
+    """
+    query = ' '.join(inline_query.get('query', '').split()).lower()[:INLINE_QUERY_MAX_LENGTH]
+    
+    cache_key = (bot_id(bot_token), query)
+    results = inline_cache_get(cache_key)
+    if results is None:
+        read_conn = get_read_connection()
+        try:
+            results = search_cached_media(read_conn, query, bot_token)
+        finally:
+            read_conn.close()
+        inline_cache_put(cache_key, results)
+    
+    answer_inline_query(inline_query['id'], results, bot_token)
+
+
+def search_cached_media(conn, query: str, bot_token: str) -> list:
+    """Поиск медиа по префиксу канала или подстроке названия (индекс pg_trgm)"""
+    schema = os.environ.get('MAIN_DB_SCHEMA', 'public')
+    cursor = conn.cursor()
+    
+    # Основной бот берёт file_id из downloads, остальные - из bot_file_ids
+    if is_primary_bot(bot_token):
+        source = f'{schema}.downloads d'
+        file_column = 'd.file_id'
     else:
-        media_info = get_telegram_file(url, bot_token, chat_id)
+        source = (f'{schema}.downloads d JOIN {schema}.bot_file_ids b '
+                  f'ON b.download_id = d.id AND b.bot_id = %(bot_id)s')
+        file_column = 'b.file_id'
+    params = {'bot_id': bot_id(bot_token), 'limit': INLINE_RESULTS_LIMIT}
+    
+    if query:
+        pattern = query.lstrip('@').replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        params['prefix'] = f'{pattern}%'
+        params['contains'] = f'%{pattern}%'
+        cursor.execute(f"""
+            SELECT d.id, {file_column}, d.media_type, d.title
+            FROM {source}
+            WHERE d.cached = true AND {file_column} IS NOT NULL
+              AND (d.channel LIKE %(prefix)s OR d.title ILIKE %(contains)s)
+            ORDER BY d.download_count DESC, d.id DESC
+            LIMIT %(limit)s
+        """, params)
+    else:
+        cursor.execute(f"""
+            SELECT d.id, {file_column}, d.media_type, d.title
+            FROM {source}
+            WHERE d.cached = true AND {file_column} IS NOT NULL
+            ORDER BY d.download_count DESC, d.id DESC
+            LIMIT %(limit)s
+        """, params)
+    
+    rows = cursor.fetchall()
+    cursor.close()
+    
+    results = []
+    for download_id, file_id, media_type, title in rows:
+        file_field = INLINE_RESULT_TYPES.get(media_type, 'document_file_id')
+        results.append({
+            'type': file_field[:-len('_file_id')],
+            'id': str(download_id),
+            file_field: file_id,
+            'title': title
+        })
+    return results
+
+
+def inline_cache_get(query: tuple):
+    """Результаты inline-запроса из памяти контейнера"""
+    entry = _inline_cache.get(query)
+    if not entry:
+        return None
+    
+    expires_at, results = entry
+    if expires_at < time.monotonic():
+        _inline_cache.pop(query, None)
+        return None
+    
+    _inline_cache.move_to_end(query)
+    return results
+
+
+def inline_cache_put(query: tuple, results: list):
+    """Сохранение результатов inline-запроса, вытесняются давно не спрашиваемые"""
+    _inline_cache[query] = (time.monotonic() + INLINE_CACHE_TTL, results)
+    _inline_cache.move_to_end(query)
+    while len(_inline_cache) > INLINE_CACHE_MAX_SIZE:
+        _inline_cache.popitem(last=False)
+
+
+def claim_update(conn, update_key: tuple) -> bool:
+    """
+    Захват обновления (bot_id, update_id) перед обработкой.
+    Повторная доставка того же обновления возвращает False и ничего не делает.
+    """
+    if update_key[1] is None:
+        return True
+    
+    schema = os.environ.get('MAIN_DB_SCHEMA', 'public')
+    cursor = conn.cursor()
+    
+    if random.random() < PROCESSED_UPDATES_CLEANUP_PROBABILITY:
+        cursor.execute(f"""
+            DELETE FROM {schema}.processed_updates
+            WHERE processed_at < CURRENT_TIMESTAMP - INTERVAL '{PROCESSED_UPDATES_TTL_HOURS} hours'
+        """)
+    
+    cursor.execute(f"""
+        INSERT INTO {schema}.processed_updates (bot_id, update_id)
+        VALUES (%s, %s)
+        ON CONFLICT (bot_id, update_id) DO NOTHING
+        RETURNING update_id
+    """, update_key)
+    
+    claimed = cursor.fetchone() is not None
+    conn.commit()
+    cursor.close()
+    
+    remember_update(update_key)
+    if not claimed:
+        _update_metrics['duplicates'] += 1
+    return claimed
+
+
+def remember_update(update_key: tuple):
+    """Добавление (bot_id, update_id) в ограниченное окно последних обновлений"""
+    if update_key[1] is None or update_key in _recent_updates:
+        return
+    
+    _recent_updates.add(update_key)
+    _recent_updates_order.append(update_key)
+    if len(_recent_updates_order) > RECENT_UPDATES_MAX_SIZE:
+        _recent_updates.discard(_recent_updates_order.popleft())
+
+
+def take_local_tokens(limits: list) -> bool:
+    """
+    Локальный token bucket контейнера.
+    Отсекает спам без обращения к БД; общий лимит проверяется отдельно.
+    """
+    now = time.monotonic()
+    buckets = []
+    
+    if len(_local_buckets) > LOCAL_BUCKETS_MAX_SIZE:
+        _local_buckets.clear()
+    
+    for key, (per_minute, burst) in limits:
+        tokens, updated = _local_buckets.get(key, (burst, now))
+        tokens = min(burst, tokens + (now - updated) * per_minute / 60)
+        if tokens < 1:
+            _local_buckets[key] = (tokens, now)
+            return False
+        buckets.append((key, tokens))
+    
+    for key, tokens in buckets:
+        _local_buckets[key] = (tokens - 1, now)
+    return True
+
+
+def take_shared_tokens(conn, limits: list) -> bool:
+    """Общий token bucket в БД: лимиты действуют на все контейнеры"""
+    schema = os.environ.get('MAIN_DB_SCHEMA', 'public')
+    cursor = conn.cursor()
+    
+    if random.random() < RATE_LIMIT_CLEANUP_PROBABILITY:
+        cursor.execute(f"""
+            DELETE FROM {schema}.rate_limits
+            WHERE updated_at < CURRENT_TIMESTAMP - INTERVAL '{RATE_LIMIT_TTL_MINUTES} minutes'
+        """)
+    
+    admitted = True
+    for key, (per_minute, burst) in limits:
+        refill = """LEAST(%(burst)s, bucket.tokens
+            + EXTRACT(EPOCH FROM (CURRENT_TIMESTAMP - bucket.updated_at)) * %(rate)s)"""
+        cursor.execute(f"""
+            INSERT INTO {schema}.rate_limits AS bucket (key, tokens, admitted, updated_at)
+            VALUES (%(key)s, %(burst)s - 1, true, CURRENT_TIMESTAMP)
+            ON CONFLICT (key)
+            DO UPDATE SET
+                tokens = CASE WHEN {refill} >= 1 THEN {refill} - 1 ELSE {refill} END,
+                admitted = {refill} >= 1,
+                updated_at = CURRENT_TIMESTAMP
+            RETURNING admitted
+        """, {'key': key, 'burst': burst, 'rate': per_minute / 60})
         
-        if media_info:
-            download_id = save_to_database(db_conn, url, media_info)
-            update_user_downloads(db_conn, user_id, download_id)
-            
-            send_downloaded_media(chat_id, media_info, bot_token)
-        else:
-            send_message(chat_id,
-                '❌ *Ошибка загрузки*\n\n'
-                'Не удалось получить медиа. Возможные причины:\n'
-                '• Неверная ссылка\n'
-                '• Канал недоступен\n'
-                '• Бот не добавлен в канал\n'
-                '• Файл удалён\n\n'
-                '💡 Добавь бота в канал как администратора для доступа к файлам!',
-                bot_token,
-                parse_mode='Markdown'
-            )
+        if not cursor.fetchone()[0]:
+            admitted = False
+            break
+    
+    conn.commit()
+    cursor.close()
+    return admitted
+
+
+def record_throttle(admitted: bool):
+    """Учёт пропущенных и отклонённых запросов"""
+    _throttle_metrics['admitted' if admitted else 'rejected'] += 1
+
+
+def memo_get(link: tuple):
+    """Запись кэша из мемо повторных ссылок"""
+    entry = _link_memo.get(link)
+    if not entry:
+        return None
+    
+    expires_at, media = entry
+    if expires_at < time.monotonic():
+        _link_memo.pop(link, None)
+        return None
+    return media
+
+
+def memo_put(link: tuple, media):
+    """Сохранение записи кэша в мемо повторных ссылок"""
+    if len(_link_memo) >= LINK_MEMO_MAX_SIZE:
+        now = time.monotonic()
+        for key in [key for key, (expires_at, _) in _link_memo.items() if expires_at < now]:
+            del _link_memo[key]
+        if len(_link_memo) >= LINK_MEMO_MAX_SIZE:
+            _link_memo.pop(next(iter(_link_memo)))
+    
+    _link_memo[link] = (time.monotonic() + LINK_MEMO_TTL, media)
+
+
+def get_bot_pool() -> list:
+    """Токены пула ботов, первый - основной"""
+    tokens = os.environ.get('TELEGRAM_BOT_TOKENS') or os.environ.get('TELEGRAM_BOT_TOKEN') or ''
+    return [token.strip() for token in tokens.split(',') if token.strip()]
+
+
+def bot_id(bot_token: str) -> int:
+    """Числовой id бота из токена"""
+    return int(bot_token.split(':')[0])
+
+
+def select_bot(event: dict):
+    """Токен бота, которому пришло обновление (?bot=<id> в адресе webhook)"""
+    pool = get_bot_pool()
+    if not pool:
+        return None
+    
+    requested = (event.get('queryStringParameters') or {}).get('bot')
+    for token in pool:
+        if token.split(':')[0] == requested:
+            return token
+    return pool[0]
+
+
+def is_primary_bot(bot_token: str) -> bool:
+    """Основной бот хранит свои file_id прямо в downloads"""
+    pool = get_bot_pool()
+    return bool(pool) and pool[0] == bot_token
+
+
+def media_for_bot(db_conn, media: media_store.MediaRow, bot_token: str) -> media_store.MediaRow:
+    """Запись кэша с file_id этого бота: file_id не переносится между ботами"""
+    if is_primary_bot(bot_token):
+        return media
+    
+    file_id = media_store.find_bot_file_id(db_conn, media.id, bot_id(bot_token))
+    return media_store.MediaRow(
+        media.id,
+        file_id,
+        media.file_url,
+        media.thumbnail_url,
+        media.file_size,
+        media.media_type,
+        media.title
+    )
+
+
+def store_media(db_conn, link: tuple, media_info: dict, bot_token: str, count: int = 1) -> int:
+    """Сохранение медиа в кэш с file_id, полученным этим ботом"""
+    if is_primary_bot(bot_token):
+        return media_store.save_media(db_conn, *link, media_info, count)
+    
+    download_id = media_store.save_media(db_conn, *link, media_info, count, shared_file_id=False)
+    media_store.save_bot_file_id(db_conn, download_id, bot_id(bot_token), media_info['file_id'])
+    return download_id
+
+
+def forget_file_id(db_conn, download_id: int, bot_token: str):
+    """Сброс недействительного file_id этого бота"""
+    if is_primary_bot(bot_token):
+        media_store.invalidate_media(db_conn, download_id)
+    else:
+        media_store.delete_bot_file_id(db_conn, download_id, bot_id(bot_token))
+
+
+def bot_state(bot_token: str) -> dict:
+    """Учёт отправок и здоровья токена в этом контейнере"""
+    state = _bot_states.get(bot_token)
+    if state is None:
+        state = {
+            'tokens': BOT_SEND_BURST,
+            'updated': time.monotonic(),
+            'sent': 0,
+            'throttled': 0,
+            'failures': 0,
+            'unhealthy_until': 0.0
+        }
+        _bot_states[bot_token] = state
+    return state
+
+
+def telegram_call(method: str, payload: dict, bot_token: str, timeout: float,
+                  idempotent: bool = False, hedge: bool = False, force: bool = False) -> dict:
+    """
+    Вызов Bot API от имени бота пула в пределах дедлайна обновления.
+    Таймаут вызова - меньшее из timeout и остатка дедлайна. Пока предохранитель
+    токена открыт, вызов сразу падает с TelegramUnavailable (force - в обход).
+    Идемпотентные вызовы с hedge=True дублируются, если первый задерживается.
+    """
+    if not force and not bot_available(bot_token):
+        _call_metrics['circuit_rejections'] += 1
+        raise TelegramUnavailable(f'{method}: circuit open')
+    
+    if hedge and idempotent:
+        return hedged_call(method, payload, bot_token, timeout)
+    return call_with_retries(method, payload, bot_token, timeout, idempotent)
+
+
+def call_with_retries(method: str, payload: dict, bot_token: str, timeout: float, idempotent: bool) -> dict:
+    """
+    Вызов с повторами на временных сбоях: экспоненциальная пауза с полным джиттером.
+    Неидемпотентные вызовы повторяются, только если запрос не ушёл (не удалось
+    подключиться) или упёрся в 429; после 5xx и обрыва сообщение могло
+    уже уйти. Ответ шлюза без JSON (HTML 502/504) считается 5xx.
+    """
+    state = bot_state(bot_token)
+    url = f'{TELEGRAM_API_BASE}/bot{bot_token}/{method}'
+    
+    for attempt in range(1, CALL_MAX_ATTEMPTS + 1):
+        call_timeout = min(timeout, remaining_budget())
+        if call_timeout < MIN_CALL_TIMEOUT:
+            _call_metrics['deadline_exceeded'] += 1
+            raise TelegramUnavailable(f'{method}: deadline exceeded')
+        
+        pace_bot(state)
+        try:
+            response = requests.post(url, json=payload, timeout=call_timeout)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            record_bot_failure(state)
+            if not (idempotent or request_not_sent(e)) or not retry_pause(attempt):
+                raise
+            continue
+        
+        state['sent'] += 1
+        try:
+            result = response.json()
+        except ValueError:
+            result = None
+        
+        if response.status_code >= 500 or not isinstance(result, dict):
+            record_bot_failure(state)
+            if not isinstance(result, dict):
+                result = {
+                    'ok': False,
+                    'error_code': response.status_code,
+                    'description': f'HTTP {response.status_code}: non-JSON response'
+                }
+            if not idempotent or not retry_pause(attempt):
+                return result
+            continue
+        
+        if response.status_code == 429:
+            retry_after = result.get('parameters', {}).get('retry_after', 1)
+            state['throttled'] += 1
+            state['unhealthy_until'] = time.monotonic() + retry_after
+            if not retry_pause(attempt, retry_after):
+                return result
+            continue
+        
+        state['failures'] = 0
+        return result
+    
+    return result
+
+
+def request_not_sent(error: Exception) -> bool:
+    """Сбой до отправки запроса: таймаут или отказ подключения"""
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(reason, NewConnectionError)
+
+
+def retry_pause(attempt: int, minimum: float = 0.0) -> bool:
+    """Пауза перед повтором; False, если попытки или бюджет дедлайна кончились"""
+    if attempt >= CALL_MAX_ATTEMPTS:
+        return False
+    
+    delay = max(minimum, random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt)))
+    if delay + MIN_CALL_TIMEOUT > remaining_budget():
+        return False
+    
+    _call_metrics['retries'] += 1
+    time.sleep(delay)
+    return True
+
+
+def hedged_call(method: str, payload: dict, bot_token: str, timeout: float) -> dict:
+    """
+    Хеджированный вызов: пока нет ответа, каждые HEDGE_DELAY отправляется
+    ещё один такой же запрос (всего до HEDGE_MAX_REQUESTS), берётся первый
+    успешный ответ.
+    """
+    futures = [_hedge_executor.submit(call_with_retries, method, payload, bot_token, timeout, True)]
+    while len(futures) < HEDGE_MAX_REQUESTS and remaining_budget() > MIN_CALL_TIMEOUT:
+        done, _ = wait(futures, timeout=min(HEDGE_DELAY, remaining_budget()), return_when=FIRST_COMPLETED)
+        if done or remaining_budget() <= MIN_CALL_TIMEOUT:
+            break
+        _call_metrics['hedges'] += 1
+        futures.append(_hedge_executor.submit(call_with_retries, method, payload, bot_token, timeout, True))
+    
+    pending = set(futures)
+    result = None
+    error = None
+    while pending:
+        done, pending = wait(pending, timeout=remaining_budget(), return_when=FIRST_COMPLETED)
+        if not done:
+            break
+        for future in done:
+            try:
+                result = future.result()
+            except Exception as e:
+                error = e
+                continue
+            if result.get('ok'):
+                return result
+    
+    if result is not None:
+        return result
+    if error is not None:
+        raise error
+    _call_metrics['deadline_exceeded'] += 1
+    raise TelegramUnavailable(f'{method}: deadline exceeded')
+
+
+def remaining_budget() -> float:
+    """Остаток дедлайна текущего обновления за вычетом запаса на ответ webhook"""
+    if _request_deadline is None:
+        return UPDATE_DEADLINE_SECONDS
+    return _request_deadline - time.monotonic() - DEADLINE_RESERVE_SECONDS
+
+
+def bot_available(bot_token: str) -> bool:
+    """Предохранитель токена закрыт (или полуоткрыт после паузы)"""
+    return bot_state(bot_token)['unhealthy_until'] <= time.monotonic()
+
+
+def send_try_later(chat_id: int, bot_token: str):
+    """Ответ «попробуй позже» не чаще раза в TRY_LATER_INTERVAL на чат, в обход предохранителя"""
+    now = time.monotonic()
+    if _try_later_sent.get(chat_id, 0) > now:
+        return
+    _try_later_sent[chat_id] = now + TRY_LATER_INTERVAL
+    
+    payload = {
+        'chat_id': chat_id,
+        'text': '⏳ Telegram сейчас отвечает с задержками, попробуй через минуту'
+    }
+    try:
+        telegram_call('sendMessage', payload, bot_token, timeout=TRY_LATER_TIMEOUT, force=True)
+    except Exception as e:
+        print(f'Error sending try-later message: {str(e)}')
+
+
+def pace_bot(state: dict):
+    """Token bucket отправок токена: при исчерпании короткое ожидание"""
+    now = time.monotonic()
+    state['tokens'] = min(BOT_SEND_BURST, state['tokens'] + (now - state['updated']) * BOT_SEND_RATE)
+    state['updated'] = now
+    
+    if state['tokens'] < 1:
+        wait = (1 - state['tokens']) / BOT_SEND_RATE
+        if wait <= BOT_MAX_PACING_WAIT:
+            time.sleep(wait)
+            state['tokens'] = 1
+            state['updated'] = time.monotonic()
+    
+    state['tokens'] -= 1
+
+
+def record_bot_failure(state: dict):
+    """Учёт сбоя вызова: после серии сбоев токен временно нездоров"""
+    state['failures'] += 1
+    if state['failures'] >= BOT_FAILURES_TO_UNHEALTHY:
+        state['unhealthy_until'] = time.monotonic() + BOT_UNHEALTHY_SECONDS
+
+
+def bot_metrics() -> dict:
+    """Отправки, 429 и здоровье каждого бота пула"""
+    now = time.monotonic()
+    metrics = {}
+    for token in get_bot_pool():
+        state = bot_state(token)
+        metrics[str(bot_id(token))] = {
+            'sent': state['sent'],
+            'throttled': state['throttled'],
+            'failures': state['failures'],
+            'healthy': state['unhealthy_until'] <= now
+        }
+    return metrics
 
 
 def is_telegram_url(text: str) -> bool:
@@ -196,7 +924,6 @@ def is_telegram_url(text: str) -> bool:
 
 def send_message(chat_id: int, text: str, bot_token: str, parse_mode: str = None):
     """Отправка сообщения пользователю"""
-    url = f'https://api.telegram.org/bot{bot_token}/sendMessage'
     payload = {
         'chat_id': chat_id,
         'text': text
@@ -206,14 +933,13 @@ def send_message(chat_id: int, text: str, bot_token: str, parse_mode: str = None
         payload['parse_mode'] = parse_mode
     
     try:
-        requests.post(url, json=payload, timeout=10)
+        telegram_call('sendMessage', payload, bot_token, timeout=10)
     except Exception as e:
         print(f'Error sending message: {str(e)}')
 
 
 def send_photo(chat_id: int, photo: str, bot_token: str, caption: str = None):
     """Отправка фото пользователю"""
-    url = f'https://api.telegram.org/bot{bot_token}/sendPhoto'
     payload = {
         'chat_id': chat_id,
         'photo': photo
@@ -224,8 +950,7 @@ def send_photo(chat_id: int, photo: str, bot_token: str, caption: str = None):
         payload['parse_mode'] = 'Markdown'
     
     try:
-        response = requests.post(url, json=payload, timeout=30)
-        return response.json()
+        return telegram_call('sendPhoto', payload, bot_token, timeout=30)
     except Exception as e:
         print(f'Error sending photo: {str(e)}')
         return None
@@ -233,7 +958,6 @@ def send_photo(chat_id: int, photo: str, bot_token: str, caption: str = None):
 
 def send_video(chat_id: int, video: str, bot_token: str, caption: str = None):
     """Отправка видео пользователю"""
-    url = f'https://api.telegram.org/bot{bot_token}/sendVideo'
     payload = {
         'chat_id': chat_id,
         'video': video
@@ -244,8 +968,7 @@ def send_video(chat_id: int, video: str, bot_token: str, caption: str = None):
         payload['parse_mode'] = 'Markdown'
     
     try:
-        response = requests.post(url, json=payload, timeout=30)
-        return response.json()
+        return telegram_call('sendVideo', payload, bot_token, timeout=30)
     except Exception as e:
         print(f'Error sending video: {str(e)}')
         return None
@@ -253,7 +976,6 @@ def send_video(chat_id: int, video: str, bot_token: str, caption: str = None):
 
 def send_document(chat_id: int, document: str, bot_token: str, caption: str = None):
     """Отправка документа пользователю"""
-    url = f'https://api.telegram.org/bot{bot_token}/sendDocument'
     payload = {
         'chat_id': chat_id,
         'document': document
@@ -264,21 +986,35 @@ def send_document(chat_id: int, document: str, bot_token: str, caption: str = No
         payload['parse_mode'] = 'Markdown'
     
     try:
-        response = requests.post(url, json=payload, timeout=30)
-        return response.json()
+        return telegram_call('sendDocument', payload, bot_token, timeout=30)
     except Exception as e:
         print(f'Error sending document: {str(e)}')
         return None
 
 
+def answer_inline_query(inline_query_id: str, results: list, bot_token: str):
+    """Ответ на inline-запрос"""
+    payload = {
+        'inline_query_id': inline_query_id,
+        'results': results,
+        'cache_time': INLINE_ANSWER_CACHE_TIME
+    }
+    
+    try:
+        telegram_call('answerInlineQuery', payload, bot_token, timeout=5)
+    except Exception as e:
+        print(f'Error answering inline query: {str(e)}')
+
+
 def set_webhook(bot_token: str, webhook_url: str):
     """Установка webhook для бота"""
-    url = f'https://api.telegram.org/bot{bot_token}/setWebhook'
-    payload = {'url': webhook_url}
+    payload = {
+        'url': webhook_url,
+        'allowed_updates': ['message', 'channel_post', 'edited_channel_post', 'inline_query']
+    }
     
     try:
-        response = requests.post(url, json=payload, timeout=10)
-        return response.json()
+        return telegram_call('setWebhook', payload, bot_token, timeout=10)
     except Exception as e:
         return {'ok': False, 'error': str(e)}
 
@@ -286,7 +1022,15 @@ def set_webhook(bot_token: str, webhook_url: str):
 def get_db_connection():
     """Подключение к базе данных"""
     dsn = os.environ.get('DATABASE_URL')
-    return psycopg2.connect(dsn)
+    return media_store.connect(dsn)
+
+
+def get_read_connection():
+    """Подключение для чтения статистики: реплика, если доступна"""
+    return media_store.connect_read(
+        os.environ.get('DATABASE_URL'),
+        os.environ.get('DATABASE_REPLICA_URL')
+    )
 
 
 def save_or_update_user(conn, user: dict):
@@ -343,138 +1087,110 @@ def update_user_downloads(conn, telegram_id: int, download_id: int):
     cursor.close()
 
 
-def check_cache(conn, url: str):
-    """Проверка кэша"""
-    schema = os.environ.get('MAIN_DB_SCHEMA', 'public')
-    cursor = conn.cursor()
-    
-    cursor.execute(f"""
-        SELECT id, file_path, thumbnail_url, file_size, media_type, title
-        FROM {schema}.downloads
-        WHERE url = %s AND cached = true
-        LIMIT 1
-    """, (url,))
-    
-    row = cursor.fetchone()
-    cursor.close()
-    
-    if row:
-        return {
-            'id': row[0],
-            'file_id': row[1],
-            'thumbnail_url': row[2],
-            'file_size': row[3],
-            'media_type': row[4],
-            'title': row[5]
-        }
-    return None
-
-
-def update_download_count(conn, download_id: int):
-    """Увеличение счетчика загрузок"""
-    schema = os.environ.get('MAIN_DB_SCHEMA', 'public')
-    cursor = conn.cursor()
-    
-    cursor.execute(f"""
-        UPDATE {schema}.downloads
-        SET download_count = download_count + 1,
-            updated_at = CURRENT_TIMESTAMP
-        WHERE id = %s
-    """, (download_id,))
-    
-    conn.commit()
-    cursor.close()
-
-
 def get_telegram_file(url: str, bot_token: str, forward_to_chat: int):
     """Получение файла из Telegram через пересылку"""
-    import re
-    
-    match = re.search(r't\.me/([^/\?]+)/(\d+)', url)
-    if not match:
+    link = media_store.parse_telegram_link(url)
+    if not link:
         return None
     
-    channel = match.group(1)
-    message_id = match.group(2)
+    channel, message_id = link
     
     from_chat = f'@{channel}' if not channel.startswith('-') else channel
     
-    api_url = f'https://api.telegram.org/bot{bot_token}/forwardMessage'
+    # Пересылка в служебный чат идемпотентна для пользователя, её можно хеджировать
+    storage = bool(TELEGRAM_STORAGE_CHAT_ID)
     payload = {
-        'chat_id': forward_to_chat,
+        'chat_id': TELEGRAM_STORAGE_CHAT_ID if storage else forward_to_chat,
         'from_chat_id': from_chat,
-        'message_id': int(message_id)
+        'message_id': int(message_id),
+        'disable_notification': True
     }
     
     try:
-        response = requests.post(api_url, json=payload, timeout=15)
-        result = response.json()
+        result = telegram_call('forwardMessage', payload, bot_token, timeout=15,
+                               idempotent=storage, hedge=storage)
         
         if not result.get('ok'):
             return None
         
-        message = result.get('result', {})
-        
-        if message.get('photo'):
-            photo = message['photo'][-1]
-            return {
-                'type': 'photo',
-                'title': f'Фото из {channel}',
-                'file_id': photo['file_id'],
-                'file_url': url,
-                'size': photo.get('file_size', 0)
-            }
-        
-        elif message.get('video'):
-            video = message['video']
-            return {
-                'type': 'video',
-                'title': f'Видео из {channel}',
-                'file_id': video['file_id'],
-                'file_url': url,
-                'size': video.get('file_size', 0),
-                'duration': video.get('duration', 0)
-            }
-        
-        elif message.get('document'):
-            doc = message['document']
-            return {
-                'type': 'document',
-                'title': doc.get('file_name', f'Файл из {channel}'),
-                'file_id': doc['file_id'],
-                'file_url': url,
-                'size': doc.get('file_size', 0)
-            }
-        
-        return None
+        media_info = extract_message_media(result.get('result', {}), channel)
+        if media_info:
+            media_info['file_url'] = media_store.canonical_url(channel, message_id)
+        return media_info
         
+    except TelegramUnavailable:
+        raise
     except Exception as e:
         print(f'Error getting Telegram file: {str(e)}')
         return None
 
 
-def send_cached_media(chat_id: int, media: dict, bot_token: str):
+def extract_message_media(message: dict, channel: str):
+    """Извлечение file_id, типа и размера медиа из сообщения"""
+    if message.get('photo'):
+        photo = message['photo'][-1]
+        return {
+            'type': 'photo',
+            'title': f'Фото из {channel}',
+            'file_id': photo['file_id'],
+            'size': photo.get('file_size', 0)
+        }
+    
+    elif message.get('video'):
+        video = message['video']
+        return {
+            'type': 'video',
+            'title': f'Видео из {channel}',
+            'file_id': video['file_id'],
+            'size': video.get('file_size', 0),
+            'duration': video.get('duration', 0)
+        }
+    
+    elif message.get('document'):
+        doc = message['document']
+        return {
+            'type': 'document',
+            'title': doc.get('file_name', f'Файл из {channel}'),
+            'file_id': doc['file_id'],
+            'size': doc.get('file_size', 0)
+        }
+    
+    return None
+
+
+def is_file_id_error(result: dict) -> bool:
+    """Ошибка 400 из-за самого file_id, а не подписи или чата"""
+    description = (result.get('description') or '').lower()
+    return any(marker in description for marker in FILE_ID_ERROR_MARKERS)
+
+
+def escape_markdown(text: str) -> str:
+    """Экранирование спецсимволов Markdown в подписи (имена файлов с _ и *)"""
+    return MARKDOWN_SPECIAL_PATTERN.sub(r'\\\1', text or '')
+
+
+def send_cached_media(chat_id: int, media: media_store.MediaRow, bot_token: str):
     """Отправка медиа из кэша"""
-    caption = f'⚡ *Из кэша!*\n\n📄 {media["title"]}\n💾 Размер: {format_file_size(media.get("file_size", 0))}'
+    caption = f'⚡ *Из кэша!*\n\n📄 {escape_markdown(media.title)}\n💾 Размер: {format_file_size(media.file_size)}'
     
-    media_type = media.get('media_type', 'photo')
-    file_id = media.get('file_id')
+    media_type = media.media_type or 'photo'
+    file_id = media.file_id
     
     if not file_id:
         send_message(chat_id, caption, bot_token, parse_mode='Markdown')
-        return
+        return None
     
     if media_type == 'photo':
-        send_photo(chat_id, file_id, bot_token, caption)
+        return send_photo(chat_id, file_id, bot_token, caption)
     elif media_type == 'video':
-        send_video(chat_id, file_id, bot_token, caption)
+        return send_video(chat_id, file_id, bot_token, caption)
     else:
-        send_document(chat_id, file_id, bot_token, caption)
+        return send_document(chat_id, file_id, bot_token, caption)
 
 
 def send_downloaded_media(chat_id: int, media: dict, bot_token: str):
     """Отправка скачанного медиа"""
-    caption = f'✅ *Готово!*\n\n📄 {media["title"]}\n💾 Размер: {format_file_size(media.get("size", 0))}'
+    caption = f'✅ *Готово!*\n\n📄 {escape_markdown(media["title"])}\n💾 Размер: {format_file_size(media.get("size", 0))}'
     
     media_type = media.get('type', 'photo')
     file_id = media.get('file_id')
@@ -491,34 +1207,6 @@ def send_downloaded_media(chat_id: int, media: dict, bot_token: str):
         send_document(chat_id, file_id, bot_token, caption)
 
 
-def save_to_database(conn, url: str, media_info: dict) -> int:
-    """Сохранение в базу данных"""
-    schema = os.environ.get('MAIN_DB_SCHEMA', 'public')
-    cursor = conn.cursor()
-    
-    file_id = media_info.get('file_id', '')
-    
-    cursor.execute(f"""
-        INSERT INTO {schema}.downloads (url, media_type, title, file_path, file_size, thumbnail_url, cached)
-        VALUES (%s, %s, %s, %s, %s, %s, %s)
-        RETURNING id
-    """, (
-        url,
-        media_info['type'],
-        media_info['title'],
-        file_id,
-        media_info.get('size', 0),
-        media_info.get('thumbnail'),
-        True
-    ))
-    
-    download_id = cursor.fetchone()[0]
-    conn.commit()
-    cursor.close()
-    
-    return download_id
-
-
 def format_file_size(size_bytes: int) -> str:
     """Форматирование размера файла"""
     if not size_bytes:
@@ -0,0 +1,99 @@
+"""
+Бенчмарк хвостовых задержек вызовов Bot API в telegram-bot.
+Поднимает локальный сервер, имитирующий Bot API с внедрённой задержкой:
+доля запросов зависает на STALL_SECONDS, остальные отвечают быстро.
+Сравнивает p50/p99 хеджированного forwardMessage и обычного вызова,
+проверяет, что длительность ограничена дедлайном обновления.
+
+Запуск: python benchmarks/bot_tail_latency.py [запросов] [доля_зависаний]
+"""
+import importlib.util
+import json
+import os
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+INDEX_PATH = os.path.join(os.path.dirname(__file__), '..', 'backend', 'telegram-bot', 'index.py')
+FAST_SECONDS = 0.02
+STALL_SECONDS = 30
+DEADLINE_SECONDS = 5
+
+
+class SlowBotApi(BaseHTTPRequestHandler):
+    stall_ratio = 0.05
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        time.sleep(STALL_SECONDS if random.random() < self.stall_ratio else FAST_SECONDS)
+        body = json.dumps({'ok': True, 'result': {'message_id': 1}}).encode('utf-8')
+        try:
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        except OSError:
+            pass
+
+    def log_message(self, *args):
+        pass
+
+
+def load_bot_module(api_base: str):
+    os.environ['TELEGRAM_API_BASE'] = api_base
+    os.environ['TELEGRAM_BOT_TOKENS'] = '1000:bench'
+    os.environ['TELEGRAM_STORAGE_CHAT_ID'] = '-1000'
+    os.environ['UPDATE_DEADLINE_SECONDS'] = str(DEADLINE_SECONDS)
+    sys.path.insert(0, os.path.dirname(INDEX_PATH))
+    spec = importlib.util.spec_from_file_location('bot_index', INDEX_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def percentile(values: list, p: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+
+def run(module, count: int, hedge: bool):
+    latencies = []
+    failures = 0
+    payload = {'chat_id': -1000, 'from_chat_id': '@bench', 'message_id': 1}
+    for _ in range(count):
+        module._request_deadline = time.monotonic() + DEADLINE_SECONDS
+        module._bot_states.clear()
+        start = time.perf_counter()
+        try:
+            module.telegram_call('forwardMessage', payload, '1000:bench', timeout=15,
+                                 idempotent=True, hedge=hedge)
+        except Exception:
+            failures += 1
+        latencies.append(time.perf_counter() - start)
+    return latencies, failures
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    SlowBotApi.stall_ratio = float(sys.argv[2]) if len(sys.argv) > 2 else 0.05
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), SlowBotApi)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    module = load_bot_module(f'http://127.0.0.1:{server.server_address[1]}')
+
+    print(f'requests={count} stall_ratio={SlowBotApi.stall_ratio} stall={STALL_SECONDS}s deadline={DEADLINE_SECONDS}s')
+    print(f'{"mode":<10} {"p50 ms":>9} {"p99 ms":>9} {"max ms":>9} {"failed":>7}')
+    for name, hedge in (('plain', False), ('hedged', True)):
+        latencies, failures = run(module, count, hedge)
+        print(f'{name:<10} {percentile(latencies, 0.5) * 1000:>9.1f} '
+              f'{percentile(latencies, 0.99) * 1000:>9.1f} {max(latencies) * 1000:>9.1f} {failures:>7}')
+    print(f'calls: {module._call_metrics}')
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""
+Бенчмарк кодирования ответов download API.
+Сравнивает размер тела на проводе и время сборки ответа из строк БД
+(форматирование размеров и дат) вместе с кодированием для полного
+и компактного форматов истории при разных Accept-Encoding.
+
+Запуск: python benchmarks/download_encoding.py [количество_строк]
+"""
+import base64
+import importlib.util
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+INDEX_PATH = os.path.join(os.path.dirname(__file__), '..', 'backend', 'download', 'index.py')
+REPEAT = 50
+
+
+def load_download_module():
+    sys.path.insert(0, os.path.dirname(INDEX_PATH))
+    spec = importlib.util.spec_from_file_location('download_index', INDEX_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def make_rows(count: int):
+    now = datetime.now()
+    rows = []
+    for i in range(count):
+        channel = f'channel_{i % 37}'
+        rows.append((
+            i + 1,
+            f'https://t.me/{channel}/{1000 + i}',
+            'video' if i % 3 else 'photo',
+            f'Медиа из {channel}',
+            f'https://t.me/{channel}/{1000 + i}',
+            1024 * (i * 97 % 50000 + 1),
+            'https://images.unsplash.com/photo-1611162617474-5b21e879e113?w=400',
+            True,
+            i % 11 + 1,
+            now - timedelta(minutes=i * 7)
+        ))
+    return rows
+
+
+def build_full(module, rows, stats_row) -> dict:
+    return {
+        'history': [module.format_history_row(row) for row in rows],
+        'stats': module.format_statistics(stats_row)
+    }
+
+
+def build_compact(module, rows, stats_row) -> dict:
+    return {
+        'columns': module.COMPACT_HISTORY_COLUMNS,
+        'delta': module.COMPACT_DELTA_COLUMNS,
+        'history': module.compact_history(rows),
+        'stats': module.compact_statistics(stats_row)
+    }
+
+
+def measure(module, event: dict, build, rows, stats_row):
+    """Время сборки ответа из строк БД (форматирование) вместе с кодированием"""
+    start = time.perf_counter()
+    for _ in range(REPEAT):
+        response = module.success_response(event, build(module, rows, stats_row))
+    elapsed = (time.perf_counter() - start) / REPEAT
+    if response.get('isBase64Encoded'):
+        wire = base64.b64decode(response['body'])
+    else:
+        wire = response['body'].encode('utf-8')
+    return len(wire), elapsed * 1000, response['headers'].get('Content-Encoding', 'identity')
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    module = load_download_module()
+    rows = make_rows(count)
+    stats_row = (count, count, sum(row[5] for row in rows), count * 3)
+
+    print(f'rows={count} json={"orjson" if module.orjson else "json"} brotli={"yes" if module.brotli else "no"}')
+    print(f'{"format":<8} {"accept-encoding":<16} {"encoding":<9} {"bytes":>9} {"ms":>8}')
+    for name, build in (('full', build_full), ('compact', build_compact)):
+        for accept in ('', 'gzip', 'gzip, br'):
+            event = {'headers': {'Accept-Encoding': accept}}
+            size, ms, encoding = measure(module, event, build, rows, stats_row)
+            print(f'{name:<8} {accept or "-":<16} {encoding:<9} {size:>9} {ms:>8.3f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,12 @@
+CREATE UNLOGGED TABLE IF NOT EXISTS download_jobs (
+    job_id VARCHAR(64) PRIMARY KEY,
+    state VARCHAR(16) NOT NULL CHECK (state IN ('queued', 'resolving', 'transferring', 'done', 'error')),
+    bytes_done BIGINT,
+    bytes_total BIGINT,
+    download_id INTEGER,
+    error TEXT,
+    version INTEGER NOT NULL DEFAULT 1,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX idx_download_jobs_updated_at ON download_jobs(updated_at);
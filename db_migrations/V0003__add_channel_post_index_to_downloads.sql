@@ -0,0 +1,9 @@
+ALTER TABLE downloads ADD COLUMN IF NOT EXISTS channel VARCHAR(255);
+ALTER TABLE downloads ADD COLUMN IF NOT EXISTS message_id BIGINT;
+
+ALTER TABLE downloads DROP CONSTRAINT IF EXISTS downloads_media_type_check;
+ALTER TABLE downloads ADD CONSTRAINT downloads_media_type_check
+    CHECK (media_type IN ('video', 'photo', 'document'));
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_downloads_channel_message
+    ON downloads(channel, message_id);
@@ -0,0 +1,8 @@
+CREATE UNLOGGED TABLE IF NOT EXISTS rate_limits (
+    key VARCHAR(64) PRIMARY KEY,
+    tokens DOUBLE PRECISION NOT NULL,
+    admitted BOOLEAN NOT NULL DEFAULT true,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX idx_rate_limits_updated_at ON rate_limits(updated_at);
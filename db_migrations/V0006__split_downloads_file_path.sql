@@ -0,0 +1,12 @@
+ALTER TABLE downloads ADD COLUMN IF NOT EXISTS file_id TEXT;
+ALTER TABLE downloads ADD COLUMN IF NOT EXISTS file_url TEXT;
+
+UPDATE downloads SET file_url = file_path
+WHERE file_url IS NULL AND file_path LIKE 'http%';
+
+UPDATE downloads SET file_id = file_path
+WHERE file_id IS NULL AND file_path IS NOT NULL AND file_path <> '' AND file_path NOT LIKE 'http%';
+
+COMMENT ON COLUMN downloads.file_id IS 'Telegram file_id для повторной отправки ботом';
+COMMENT ON COLUMN downloads.file_url IS 'Ссылка на медиа для веб-клиента';
+COMMENT ON COLUMN downloads.file_path IS 'Устарело: заменено file_id и file_url';
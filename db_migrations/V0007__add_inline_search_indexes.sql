@@ -0,0 +1,13 @@
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+CREATE INDEX IF NOT EXISTS idx_downloads_title_trgm
+    ON downloads USING gin (title gin_trgm_ops)
+    WHERE cached = true AND file_id IS NOT NULL;
+
+CREATE INDEX IF NOT EXISTS idx_downloads_channel_prefix
+    ON downloads (channel text_pattern_ops)
+    WHERE cached = true AND file_id IS NOT NULL;
+
+CREATE INDEX IF NOT EXISTS idx_downloads_popular
+    ON downloads (download_count DESC, id DESC)
+    WHERE cached = true AND file_id IS NOT NULL;
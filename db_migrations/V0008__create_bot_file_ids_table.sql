@@ -0,0 +1,9 @@
+CREATE TABLE IF NOT EXISTS bot_file_ids (
+    download_id INTEGER NOT NULL REFERENCES downloads(id),
+    bot_id BIGINT NOT NULL,
+    file_id TEXT NOT NULL,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (download_id, bot_id)
+);
+
+CREATE INDEX idx_bot_file_ids_bot_id ON bot_file_ids(bot_id);
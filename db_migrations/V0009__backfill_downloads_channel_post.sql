@@ -0,0 +1,26 @@
+-- Ключ поста (channel, message_id) для записей, созданных до V0003.
+-- Разбор ссылки совпадает с media_store.parse_telegram_link; из нескольких
+-- записей одного поста ключ получает самая ранняя, остальные остаются без него.
+WITH parsed AS (
+    SELECT id, regexp_match(url, '(?:t\.me|telegram\.me)/(?:(c)/(\d+)|(?:s/)?([A-Za-z0-9_]+))/(\d+)') AS link
+    FROM downloads
+    WHERE channel IS NULL AND message_id IS NULL
+), posts AS (
+    SELECT DISTINCT ON (channel, message_id) id, channel, message_id
+    FROM (
+        SELECT id,
+               CASE WHEN link[1] = 'c' THEN '-100' || link[2] ELSE lower(link[3]) END AS channel,
+               link[4]::BIGINT AS message_id
+        FROM parsed
+        WHERE link IS NOT NULL
+    ) AS keyed
+    ORDER BY channel, message_id, id
+)
+UPDATE downloads
+SET channel = posts.channel, message_id = posts.message_id
+FROM posts
+WHERE downloads.id = posts.id
+  AND NOT EXISTS (
+      SELECT 1 FROM downloads AS existing
+      WHERE existing.channel = posts.channel AND existing.message_id = posts.message_id
+  );
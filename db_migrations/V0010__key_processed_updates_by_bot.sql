@@ -0,0 +1,7 @@
+-- update_id нумеруется отдельно для каждого бота пула: ключ дедупликации (bot_id, update_id).
+-- Старые записи получают bot_id = 0 и уходят по TTL.
+ALTER TABLE processed_updates ADD COLUMN IF NOT EXISTS bot_id BIGINT NOT NULL DEFAULT 0;
+ALTER TABLE processed_updates ALTER COLUMN bot_id DROP DEFAULT;
+
+ALTER TABLE processed_updates DROP CONSTRAINT IF EXISTS processed_updates_pkey;
+ALTER TABLE processed_updates ADD PRIMARY KEY (bot_id, update_id);
@@ -28,9 +28,45 @@ interface StatsData {
 
 const API_URL = 'https://functions.poehali.dev/d811f6bc-037a-4fbb-907a-d8d81a993ed5';
 
+interface JobProgress {
+  state: 'queued' | 'resolving' | 'transferring' | 'done' | 'error' | 'unknown';
+  bytes_done: number | null;
+  bytes_total: number | null;
+}
+
+const progressValue = (job: JobProgress | null) => {
+  if (!job) return 5;
+  switch (job.state) {
+    case 'queued':
+      return 10;
+    case 'resolving':
+      return 33;
+    case 'transferring':
+      return job.bytes_total ? 33 + (67 * (job.bytes_done || 0)) / job.bytes_total : 66;
+    case 'done':
+      return 100;
+    default:
+      return 5;
+  }
+};
+
+const progressLabel = (job: JobProgress | null) => {
+  switch (job?.state) {
+    case 'resolving':
+      return 'Получение информации о файле...';
+    case 'transferring':
+      return 'Передача файла...';
+    case 'done':
+      return 'Готово!';
+    default:
+      return 'Обработка материала...';
+  }
+};
+
 const Index = () => {
   const [url, setUrl] = useState('');
   const [isLoading, setIsLoading] = useState(false);
+  const [progress, setProgress] = useState<JobProgress | null>(null);
   const [history, setHistory] = useState<DownloadItem[]>([]);
   const [stats, setStats] = useState<StatsData>({
     totalDownloads: 0,
@@ -44,9 +80,9 @@ const Index = () => {
     loadData();
   }, []);
 
-  const loadData = async () => {
+  const loadData = async (readAfter?: string) => {
     try {
-      const response = await fetch(API_URL);
+      const response = await fetch(readAfter ? `${API_URL}?after=${encodeURIComponent(readAfter)}` : API_URL);
       if (response.ok) {
         const data = await response.json();
         setHistory(data.history || []);
@@ -68,13 +104,24 @@ const Index = () => {
     }
 
     setIsLoading(true);
+    setProgress(null);
+
+    const jobId = crypto.randomUUID();
+    const events = new EventSource(`${API_URL}?action=progress&stream=sse&job_id=${jobId}`);
+    const handleProgress = (event: MessageEvent) => setProgress(JSON.parse(event.data));
+    events.addEventListener('progress', handleProgress);
+    events.addEventListener('end', (event) => {
+      handleProgress(event as MessageEvent);
+      events.close();
+    });
+
     try {
       const response = await fetch(API_URL, {
         method: 'POST',
         headers: {
           'Content-Type': 'application/json'
         },
-        body: JSON.stringify({ url })
+        body: JSON.stringify({ url, job_id: jobId })
       });
 
       const data = await response.json();
@@ -87,7 +134,7 @@ const Index = () => {
             : 'Материал загружен и доступен для скачивания'
         });
         setUrl('');
-        loadData();
+        loadData(data.read_after);
       } else {
         toast({
           title: 'Ошибка',
@@ -102,6 +149,7 @@ const Index = () => {
         variant: 'destructive'
       });
     } finally {
+      events.close();
       setIsLoading(false);
     }
   };
@@ -188,9 +236,9 @@ const Index = () => {
                 </div>
                 {isLoading && (
                   <div className="space-y-2">
-                    <Progress value={66} className="h-2" />
+                    <Progress value={progressValue(progress)} className="h-2" />
                     <p className="text-sm text-muted-foreground text-center">
-                      Обработка материала...
+                      {progressLabel(progress)}
                     </p>
                   </div>
                 )}